@@ -20,15 +20,17 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import logging
 import os
-import random
 import struct
 
-from google.appengine.ext import webapp
+from google.appengine.ext import db, webapp
 from google.appengine.ext.webapp import util
 
+import codec
+import idpool
 import member
+import notify
+import syncUsers
 
 
 class AssignUser(webapp.RequestHandler):
@@ -70,67 +72,53 @@ class AssignUser(webapp.RequestHandler):
          
         # unpack all incoming data
         server = int(CURRENT_VERSION_ID[0:8], 16)
-        client = (struct.unpack("!i", data[0:4]))[0]
-        data = data[4:]
+        reader = codec.Reader(data)
+        client = reader.read_int()
+        data = reader.read_rest()
  
         # client version check
         if client < INT_VERCLIENT:
             self.resp_simple(0, ('Client version mismatch; %s required.  Download latest client release first.' % STR_VERCLIENT))
             return        
 
-        # assign grouping id number
-        num = 1
-        while (num > 0):
-            # we get the current numbers in the database
-            query = member.Member.all()
-            num = query.count()
-
-            # we know how many are left in the current range
-            if (num >= 999):
-                maxUsers = 9999
-            elif (num >= 99):
-                maxUsers = 999
-            else:
-                maxUsers = 99
-
-            # we know we can build a set of what remains
-            used = []
-            for m in query:
-                used.append(m.usr_id)
-                
-                # each commitment must be unique
-                if str(m.commitment) == str(data):
-                    self.resp_simple(0, 'Request was formatted incorrectly.')
-                    return        
-
-            # create a super set of all items from smallest to largest
-            # also don't assign 1-10 so that users won't confuse the # of users with the grouping id 
-            full = set(xrange(11, maxUsers + 1))
-            avail = sorted(full - set(used))   
-    
-            # we know can get a random number of the remaining range
-            # we know what position the random number will be at
-            # we know the new number
-            r = random.SystemRandom()
-            usrid = r.choice(avail)       
-
-            # we check the new number against the database again
-            query = member.Member.all()
-            query.filter('usr_id =', usrid)
-            num = query.count()
-
-            # if number is taken by now, we start over again
-            if num > 0:
-                logging.info("found duplicate usr_id=" + str(usrid) + ", retrying...")
+        # each commitment must be unique
+        try:
+            claimed = member.claim_commitment(data)
+        except db.TransactionFailedError:
+            self.resp_simple(0, 'Unable to create new user.')
+            return
+        if not claimed:
+            self.resp_simple(0, 'Request was formatted incorrectly.')
+            return        
+
+        # assign grouping id number from the pool of free ids
+        usrid = idpool.allocate()
+        if usrid is None:
+            db.delete(member.commitment_key(data))
+            self.resp_simple(0, 'Unable to create new user.')
+            return       
  
         # return the user id
-        mem = member.Member(usr_id=usrid, commitment=data, client_ver=client)
-        mem.put()
+        mem = member.Member(key_name=str(usrid), usr_id=usrid, client_ver=client)
+        commitment = member.Payload(key=member.payload_key('commitment', usrid), value=data)
+        db.put([mem, commitment])
         key = mem.key()
         if not key.has_id_or_name():
             self.resp_simple(0, 'Unable to create new user.')
             return       
                               
+        # optionally commit to a group number in the same round trip
+        usridlink = link_arg(self.request.GET.get('link'))
+        if usridlink is not None:
+            if not syncUsers.link_member(mem, usridlink):
+                self.resp_simple(0, 'Unable to update user.')
+                return
+
+            # version, user id assigned, then the group's commitments as from syncUsers
+            wait = notify.wait_seconds(self.request.GET.get('wait'))
+            syncUsers.write_commitments(self.response.out, (server, usrid), usridlink, (usrid,), wait)
+            return
+
         # version
         self.response.out.write('%s' % struct.pack('!i', server))
 
@@ -141,10 +129,20 @@ class AssignUser(webapp.RequestHandler):
         self.response.out.write('%s%s' % (struct.pack('!i', code), msg))
     
 
+def link_arg(value):
+    # group number to link to, None keeps the plain assignment response
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+application = webapp.WSGIApplication([('/assignUser', AssignUser),
+                                 ],
+                                 debug=True)
+
+
 def main():
-    application = webapp.WSGIApplication([('/assignUser', AssignUser),
-                                     ],
-                                     debug=True)
     util.run_wsgi_app(application)
 
 
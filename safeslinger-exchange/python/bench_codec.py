@@ -0,0 +1,75 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Benchmark of request parsing: the reslicing loop the handlers used to run,
+# where every 'data = data[4:]' copies the rest of the body, against
+# codec.Reader's offsets into a memoryview. Run it outside App Engine:
+#
+#   python bench_codec.py
+
+import struct
+import timeit
+
+import codec
+
+
+ID_COUNTS = (10, 100, 1000, 5000)
+BLOB_LENGTH = 4096
+
+
+def reslice_parse(data):
+    # as syncData parsed a request before the codec
+    client = (struct.unpack("!i", data[0:4]))[0]
+    data = data[4:]
+    usrids = []
+    usrid = (struct.unpack("!i", data[0:4]))[0]
+    numEntry = (struct.unpack("!i", data[4:8]))[0]
+    data = data[8:]
+    while numEntry > len(usrids):
+        usrids.append(struct.unpack("!i", data[0:4])[0])
+        data = data[4:]
+    return client, usrid, tuple(usrids), data[0:]
+
+
+def reader_parse(data):
+    reader = codec.Reader(data)
+    client = reader.read_int()
+    usrid = reader.read_int()
+    numEntry = reader.read_int()
+    usrids = reader.read_ids(numEntry)
+    return client, usrid, usrids, reader.read_rest()
+
+
+def main():
+    print '%8s %10s %14s %14s %8s' % ('ids', 'bytes', 'reslice ms', 'reader ms', 'speedup')
+    for count in ID_COUNTS:
+        ids = range(11, 11 + count)
+        data = struct.pack('!iii%di' % count, 0x01060000, 11, count, *ids) + 'b' * BLOB_LENGTH
+        assert reslice_parse(data) == reader_parse(data)
+        number = max(1, 20000 // count)
+        old = min(timeit.repeat(lambda: reslice_parse(data), number=number, repeat=3)) / number
+        new = min(timeit.repeat(lambda: reader_parse(data), number=number, repeat=3)) / number
+        print '%8d %10d %14.3f %14.3f %7.0fx' % (count, len(data), old * 1000, new * 1000, old / new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Micro-benchmark of the group delta: the nested per-member scan the sync
+# handlers used to run against delta.phase_delta, for groups up to the
+# 1000-member fetch limit. Plain Python, run it outside App Engine:
+#
+#   python bench_delta.py
+
+import struct
+import timeit
+
+import codec
+import delta
+
+
+GROUP_SIZES = (10, 100, 250, 500, 1000)
+VALUE_LENGTH = 256
+
+
+def nested_delta(rows, usrids):
+    # as the handlers did it: one scan of the known ids per member, once to
+    # count and again to emit
+    out = []
+    num = 0
+    for usrid, value in rows:
+        if value != None:
+            num = num + 1
+    out.append(struct.pack('!i', num))
+    num = 0
+    for usrid, value in rows:
+        posted = False
+        for known in usrids:
+            if known == usrid:
+                posted = True
+        if (not posted) & (value != None):
+            num = num + 1
+    out.append(struct.pack('!i', num))
+    for usrid, value in rows:
+        posted = False
+        for known in usrids:
+            if known == usrid:
+                posted = True
+        if (not posted) & (value != None):
+            out.append('%s%s' % (struct.pack('!ii', usrid, len(value)), value))
+    return ''.join(out)
+
+
+def set_delta(rows, usrids):
+    total, entries = delta.phase_delta(rows, usrids)
+    return codec.pack_delta((total, len(entries)), entries)
+
+
+def main():
+    print '%8s %14s %14s %8s' % ('members', 'nested ms', 'set ms', 'speedup')
+    for size in GROUP_SIZES:
+        rows = [(usrid, 'v' * VALUE_LENGTH) for usrid in xrange(11, 11 + size)]
+        # a client part way through the phase knows half the group
+        usrids = tuple(usrid for usrid, value in rows[::2])
+        assert nested_delta(rows, usrids) == set_delta(rows, usrids)
+        number = max(1, 2000 // size)
+        nested = min(timeit.repeat(lambda: nested_delta(rows, usrids), number=number, repeat=3)) / number
+        fast = min(timeit.repeat(lambda: set_delta(rows, usrids), number=number, repeat=3)) / number
+        print '%8d %14.3f %14.3f %7.0fx' % (size, nested * 1000, fast * 1000, nested / fast)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Bytes read from the datastore per sync poll, for the old layout where
+# every poll fetched whole Member entities with all five phase blobs, and
+# for the Payload / GroupIndex layout. The datastore is not available
+# outside App Engine, so reads are counted from the entity sizes each
+# layout fetches rather than measured:
+#
+#   python bench_poll.py
+
+GROUP_SIZES = (10, 100, 500, 1000)
+
+# typical value sizes of a member's phases in bytes
+PHASE_BYTES = {
+    'commitment': 32,
+    'data': 2048,
+    'signature': 256,
+    'match': 32,
+    'key_node': 512,
+}
+
+# entity key, properties and metadata around the values
+ENTITY_OVERHEAD = 64
+
+
+def old_poll(size, phase):
+    # query.fetch(1000) on usr_id_link: every member with every blob
+    return size * (ENTITY_OVERHEAD + sum(PHASE_BYTES.values()))
+
+
+def index_bytes(size):
+    # GroupIndex: ids, client versions, fetched and the counted posts
+    posted = sum(len('%s:%d' % (phase, 1000 + i)) for phase in ('commitment', 'data', 'signature', 'match')
+                 for i in xrange(size))
+    return ENTITY_OVERHEAD + size * 4 * 3 + posted
+
+
+def new_poll(size, phase, changed):
+    # aggregate from the GroupIndex; the phase's payloads only when the
+    # totals show a post the client lacks, and none of it when groupcache
+    # already holds a snapshot
+    read = index_bytes(size)
+    if changed:
+        read += size * (ENTITY_OVERHEAD + PHASE_BYTES[phase])
+    return read
+
+
+def main():
+    print '%8s %10s %14s %14s %14s' % ('members', 'phase', 'old bytes', 'new changed', 'new unchanged')
+    for size in GROUP_SIZES:
+        for phase in ('commitment', 'data', 'match'):
+            print '%8d %10s %14d %14d %14d' % (size, phase, old_poll(size, phase),
+                                                new_poll(size, phase, True), new_poll(size, phase, False))
+
+
+if __name__ == '__main__':
+    main()
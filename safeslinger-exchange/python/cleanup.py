@@ -21,13 +21,31 @@
 # THE SOFTWARE.
 
 import datetime
+import logging
+import time
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import db, webapp
 from google.appengine.ext.webapp import util
 
+import eventlog
+import eviction
+import groupcache
+import idpool
 import member
 
 
+# expired kinds are drained in this order, members first
+KINDS = [member.Member, idpool.UserIdSlot, member.Commitment, member.Payload, member.GroupIndex, member.GroupEvent]
+
+BATCH_SIZE = 500
+# ids are released with their members; a slot is only swept on its own,
+# as one whose member was never stored, this long after members expire
+ORPHAN_SLOT_AGE = datetime.timedelta(seconds=600)
+TIME_BUDGET = 30  # seconds of work per request before continuing in a task
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
 # import connection
 class CleanUp(webapp.RequestHandler):
     
@@ -41,17 +59,98 @@ class CleanUp(webapp.RequestHandler):
             # exchange life cycle reasonably limited to 10 minutes, as depends on user confirmation
             deltaMem = datetime.timedelta(seconds=600)  # 10 minutes
             thenMem = now - deltaMem
-            query = db.Query(member.Member).filter('inserted <', thenMem)
-            mems = []
-            for m in query:
-                mems.append(m)
-            
-            db.delete(mems)
+            self.drain(thenMem, 0, None)
+
+        # continuation of an earlier run that ran out of time
+        elif self.request.headers.get('X-AppEngine-TaskName') != None:
+            thenMem = datetime.datetime.strptime(self.request.get('before'), DATE_FORMAT)
+            self.drain(thenMem, int(self.request.get('kind')), self.request.get('cursor') or None)
+
+    def drain(self, thenMem, kind, cursor):
+        # delete expired keys in batches, resuming from kind and cursor
+        start = time.time()
+        deleted = 0
+        batches = 0
+        while kind < len(KINDS):
+            # members are read whole, their group and payloads go with them
+            cutoff = thenMem
+            if KINDS[kind] is idpool.UserIdSlot:
+                cutoff = thenMem - ORPHAN_SLOT_AGE
+            query = KINDS[kind].all(keys_only=KINDS[kind] is not member.Member).filter('inserted <', cutoff)
+            if cursor:
+                query.with_cursor(cursor)
+            batch = query.fetch(BATCH_SIZE)
+
+            if batch:
+                if KINDS[kind] is member.Member:
+                    member.expire_members(batch)
+                    idpool.release([idpool.slot_key(mem.usr_id) for mem in batch])
+                elif KINDS[kind] is idpool.UserIdSlot:
+                    # free ids reserved for members that were never stored,
+                    # a live member keeps its id until it expires itself
+                    mems = member.get_members([int(key.name()) for key in batch])
+                    idpool.release([key for key, mem in zip(batch, mems) if mem is None])
+                else:
+                    db.delete(batch)
+                    if KINDS[kind] is member.GroupIndex:
+                        # the link may be handed out again
+                        eventlog.forget(*[int(key.name()) for key in batch])
+                deleted += len(batch)
+                batches += 1
+
+            if len(batch) < BATCH_SIZE:
+                kind += 1
+                cursor = None
+            else:
+                cursor = query.cursor()
+
+            # hand the rest of the backlog to a task before hitting the deadline
+            if kind < len(KINDS) and time.time() - start > TIME_BUDGET:
+                taskqueue.add(url='/cron/cleanup', method='GET', params={
+                    'before': thenMem.strftime(DATE_FORMAT),
+                    'kind': kind,
+                    'cursor': cursor or ''})
+                logging.info('cleanup: continuing with %s in a task' % KINDS[kind].kind())
+                break
+
+        elapsed = time.time() - start
+        if deleted > 0:
+            logging.info('cleanup: deleted=%i keys in %i batches, %.2f secs, %.1f keys/sec' % (deleted, batches, elapsed, deleted / max(elapsed, 0.001)))
+
+
+class Evict(webapp.RequestHandler):
+    
+    def get(self):
+
+        # execute only when queued by a sync request, see eviction.match_fetched
+        if self.request.headers.get('X-AppEngine-TaskName') != None:
+            eviction.evict(int(self.request.get('link')))
         
 
+class LogPosts(webapp.RequestHandler):
+    
+    def post(self):
+
+        # execute only when queued by a post whose group index was contended,
+        # see member.post_payloads; a failure is retried by the queue
+        if self.request.headers.get('X-AppEngine-TaskName') != None:
+            usridlink = int(self.request.get('link'))
+            posts = []
+            for name in self.request.get_all('post'):
+                phase, usrid = name.split(':')
+                posts.append((phase, int(usrid)))
+            seq = member.log_posts(usridlink, posts)
+            eventlog.published(usridlink, seq)
+            groupcache.invalidate(usridlink)
+
+
+application = webapp.WSGIApplication([('/cron/cleanup', CleanUp),
+                                      ('/cron/evict', Evict),
+                                      (member.LOG_POSTS_URL, LogPosts)],
+                                     debug=True)
+
+
 def main():
-    application = webapp.WSGIApplication([('/cron/cleanup', CleanUp)],
-                                         debug=True)
     util.run_wsgi_app(application)
 
 
@@ -0,0 +1,120 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import binascii
+import itertools
+import struct
+
+
+# entries packed per write when a response is emitted in pages
+PAGE_SIZE = 500
+
+
+class IdBitmap(object):
+    # set of known usr_ids sent as a bitmap, bit (usr_id & 7) of byte
+    # (usr_id >> 3) is set for each id; membership is a byte lookup
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.count = 0
+        if bits:
+            self.count = bin(int(binascii.hexlify(bits), 16)).count('1')
+
+    def __contains__(self, usrid):
+        i = usrid >> 3
+        return 0 <= i < len(self.bits) and (ord(self.bits[i]) >> (usrid & 7)) & 1 == 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(len(self.bits)):
+            byte = ord(self.bits[i])
+            for j in xrange(8):
+                if (byte >> j) & 1:
+                    yield (i << 3) + j
+
+
+
+class Reader(object):
+    # offset-based reader over the request body, fields are unpacked in place
+    # from a memoryview instead of reslicing the remaining buffer each time
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.view = memoryview(data)
+        self.pos = pos
+
+    def remaining(self):
+        return len(self.data) - self.pos
+
+    def read_int(self):
+        value = struct.unpack_from('!i', self.view, self.pos)[0]
+        self.pos = self.pos + 4
+        return value
+
+    def read_ints(self, n):
+        # bulk unpack of an id array
+        if n <= 0:
+            return ()
+        values = struct.unpack_from('!%di' % n, self.view, self.pos)
+        self.pos = self.pos + (4 * n)
+        return values
+
+    def read_ids(self, n):
+        # known usr_ids: n ids, or a bitmap of -n bytes when n is negative
+        if n >= 0:
+            return self.read_ints(n)
+        return IdBitmap(self.read_blob(-n))
+
+    def read_blob(self, n):
+        value = self.view[self.pos:(self.pos + n)].tobytes()
+        self.pos = self.pos + n
+        return value
+
+    def read_rest(self):
+        return self.read_blob(self.remaining())
+
+
+def pack_delta(header, entries):
+    # whole response in one struct.pack: the !i header fields followed by
+    # each (usr_id, length, blob) entry, so a response is one allocation
+    fmt = ['!%di' % len(header)]
+    args = list(header)
+    for usrid, value in entries:
+        length = str.__len__(value)
+        fmt.append('ii%ds' % length)
+        args.extend((usrid, length, value))
+    return struct.pack(''.join(fmt), *args)
+
+
+def write_delta(out, header, entries):
+    # pack_delta emitted a page of entries at a time, so a large group is
+    # never packed into a single buffer; small groups are still one write.
+    # entries may be any iterable, only one page of it is read at a time
+    entries = iter(entries)
+    out.write(pack_delta(header, itertools.islice(entries, PAGE_SIZE)))
+    while True:
+        page = list(itertools.islice(entries, PAGE_SIZE))
+        if not page:
+            break
+        out.write(pack_delta((), page))
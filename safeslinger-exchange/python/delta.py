@@ -0,0 +1,81 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import codec
+
+
+# default used for members that did not report a client version
+INT_VERCLIENT = 0x01060000
+
+# phase ids used by the batched sync request, mapped to the payload phase name
+PHASE_USERS = 1
+PHASE_DATA = 2
+PHASE_SIGNATURES = 3
+PHASE_MATCH = 4
+PHASE_KEYNODES = 5
+
+PHASE_FIELDS = {
+    PHASE_USERS: 'commitment',
+    PHASE_DATA: 'data',
+    PHASE_SIGNATURES: 'signature',
+    PHASE_MATCH: 'match',
+    PHASE_KEYNODES: 'key_node',
+}
+
+
+def known_ids(usrids):
+    # the client's ids as a set, a bitmap already is one
+    if isinstance(usrids, codec.IdBitmap):
+        return usrids
+    return set(usrids)
+
+
+def phase_delta(rows, usrids):
+    # one pass over the group's (usr_id, value) rows for a phase: count
+    # members that posted it and collect the ones the client does not know
+    known = known_ids(usrids)
+    total = 0
+    entries = []
+    for usrid, value in rows:
+        if value != None:
+            total = total + 1
+            if usrid not in known:
+                entries.append((usrid, value))
+    return total, entries
+
+
+def lowest_version(rows):
+    # get lowest available version from the group's (usr_id, client_ver) rows
+    lowest = 0
+    for usrid, client_ver in rows:
+        if client_ver != None:
+            cur = client_ver
+        else:
+            cur = INT_VERCLIENT  # default
+
+        if lowest == 0:
+            lowest = cur  # needs a starting point
+
+        if cur < lowest:
+            lowest = cur
+
+    return lowest
@@ -0,0 +1,117 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import member
+import notify
+
+
+# cached sequence numbers outlive no exchange, a miss is read from the index
+SEQ_TTL = 600
+
+
+def since_arg(value):
+    # sequence number the client has seen, None keeps the usr_id list protocol
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _seq_key(usridlink):
+    return 'grp:seq:%d' % usridlink
+
+
+def published(usridlink, seq):
+    # raise the cached sequence number to seq, never lowering it
+    if usridlink == None or seq is None:
+        return
+    client = memcache.Client()
+    for i in xrange(8):
+        cur = client.gets(_seq_key(usridlink))
+        if cur is None:
+            if client.add(_seq_key(usridlink), seq, time=SEQ_TTL):
+                return
+        elif cur >= seq:
+            return
+        elif client.cas(_seq_key(usridlink), seq, time=SEQ_TTL):
+            return
+    memcache.delete(_seq_key(usridlink))
+
+
+def forget(*usridlinks):
+    # drop the cached sequence numbers of deleted groups, their ids may be reused
+    memcache.delete_multi([_seq_key(usridlink) for usridlink in usridlinks])
+
+
+def latest(usridlink):
+    # latest sequence number of the group, from memcache or the group index
+    seq = memcache.get(_seq_key(usridlink))
+    if seq is None:
+        index = db.get(member.group_key(usridlink))
+        seq = 0
+        if index is not None:
+            seq = index.seq
+        memcache.add(_seq_key(usridlink), seq, time=SEQ_TTL)
+    return seq
+
+
+def phase_since(usridlink, phase, since):
+    # latest sequence number and the (usr_id, value) posts of a phase logged
+    # after since; nothing new is answered from memcache alone
+    if usridlink == None:
+        return since, []
+    seq = latest(usridlink)
+    if since >= seq:
+        return seq, []
+
+    query = member.GroupEvent.all().ancestor(member.group_key(usridlink))
+    query.filter('phase =', phase).filter('seq >', since)
+    usrids = []
+    for event in query:
+        seq = max(seq, event.seq)
+        if event.usr_id not in usrids:
+            usrids.append(event.usr_id)
+
+    entries = []
+    for usrid, value in member.iter_payloads(phase, usrids):
+        if value != None:
+            entries.append((usrid, value))
+    return seq, entries
+
+
+def poll_since(usridlink, phase, since, wait):
+    # phase_since, held until something new is logged when long-polling
+    deadline = time.time() + wait
+    while True:
+        version = None
+        if usridlink != None:
+            version = notify.channel.version(usridlink)
+        seq, entries = phase_since(usridlink, phase, since)
+        remain = deadline - time.time()
+        if entries or remain <= 0 or version is None:
+            return seq, entries
+        notify.channel.wait(usridlink, version, remain)
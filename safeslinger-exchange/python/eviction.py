@@ -0,0 +1,85 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import delta
+import eventlog
+import groupcache
+import idpool
+import member
+
+
+# grace period after the last member fetched the matches, so lost responses
+# can still be retried before the group disappears
+EVICT_DELAY = 30
+
+
+def match_fetched(usridlink, usrid, total):
+    # called after a member was sent the match phase holding total matches,
+    # schedules deletion of the group once every member has received every
+    # match
+    if usridlink == None:
+        return
+    aggregate = groupcache.get_aggregate(usridlink)
+    if total == 0 or total < aggregate['commitment']:
+        return  # the member does not have every match yet
+    try:
+        done = member.fetch_done(usridlink, usrid)
+    except db.TransactionFailedError:
+        # the response is already written, the cron removes the group later
+        logging.warning('unable to record match fetch, usr_id_link=%i usr_id=%i' % (usridlink, usrid))
+        return
+    if done:
+        taskqueue.add(url='/cron/evict', method='GET', params={'link': usridlink}, countdown=EVICT_DELAY)
+
+
+def evict(usridlink):
+    # delete a completed group: its index and log, the members, their phase
+    # values and their id reservations
+    index = db.get(member.group_key(usridlink))
+    if index is None:
+        return 0
+    # an id listed by the index may since have expired and been handed to
+    # someone else, only delete those still linked to this group
+    usrids = []
+    for i in xrange(0, len(index.usr_ids), member.PAGE_SIZE):
+        for mem in member.get_members(index.usr_ids[i:i + member.PAGE_SIZE]):
+            if mem is not None and mem.usr_id_link == usridlink:
+                usrids.append(mem.usr_id)
+    query = member.GroupEvent.all(keys_only=True).ancestor(index)
+    keys = list(query)
+    keys.append(index.key())
+    for usrid in usrids:
+        keys.append(member.member_key(usrid))
+        for phase in delta.PHASE_FIELDS.values():
+            keys.append(member.payload_key(phase, usrid))
+    for i in xrange(0, len(keys), member.PAGE_SIZE):
+        db.delete(keys[i:i + member.PAGE_SIZE])
+    idpool.release([idpool.slot_key(usrid) for usrid in usrids])
+    eventlog.forget(usridlink)
+    groupcache.invalidate(usridlink)
+    logging.info('evicted group %i with %i members' % (usridlink, len(usrids)))
+    return len(keys)
@@ -0,0 +1,183 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import delta
+import member
+import notify
+
+
+# group reads are strongly consistent, the expiry only bounds how long a
+# snapshot may outlive a lost invalidation
+SNAPSHOT_TTL = 5
+
+# the instance cache is bounded by the bytes of the values it holds, a
+# single snapshot may be at most the memcache value size
+LOCAL_MAX_BYTES = 16 * 1024 * 1024
+SNAPSHOT_MAX_BYTES = 1000000
+
+# phases posted by more members than this are not snapshot at all, their
+# deltas are read a page at a time while the response is written
+STREAM_MIN_POSTS = member.PAGE_SIZE
+
+# (usr_id_link, phase) -> (version, expires, rows, size), least recently used first
+_local = collections.OrderedDict()
+_local_size = 0
+_local_lock = threading.Lock()
+
+
+class _Stream(object):
+    # entries of a large phase, payloads are only read when iterated
+
+    def __init__(self, phase, usrids):
+        self.phase = phase
+        self.usrids = usrids
+
+    def __len__(self):
+        return len(self.usrids)
+
+    def __iter__(self):
+        for usrid, value in member.iter_payloads(self.phase, self.usrids):
+            # the count is already sent, a payload deleted since the
+            # index was read goes out empty to keep the framing
+            if value == None:
+                value = ''
+            yield usrid, value
+
+
+def _snapshot_key(usridlink, phase, version):
+    return 'grp:snap:%d:%s:%d' % (usridlink, phase, version)
+
+
+def invalidate(usridlink):
+    # called after any post changing a member of the group
+    if usridlink != None:
+        notify.channel.publish(usridlink)
+
+
+def get_phase(usridlink, phase):
+    # (usr_id, value) rows of one phase for the group, served from the
+    # instance, then memcache, then datastore
+    if usridlink == None:
+        return []  # not linked to a group yet
+    return _cached(usridlink, phase, member.get_phase)
+
+
+def get_aggregate(usridlink):
+    # phase totals and lowest client version of the group, cached like a phase
+    if usridlink == None:
+        return member.get_aggregate(None)
+    return _cached(usridlink, 'aggregate', _load_aggregate)
+
+
+def _load_aggregate(usridlink, phase):
+    return member.get_aggregate(usridlink)
+
+
+def lowest_version(usridlink):
+    return get_aggregate(usridlink)['low_client']
+
+
+def phase_delta(usridlink, usrids, phase):
+    # the aggregate answers a poll with nothing new without reading the
+    # phase; the client's ids all came from the group, so while no member
+    # has left an equal count means it already has every post
+    aggregate = get_aggregate(usridlink)
+    total = aggregate.get(phase)
+    if total is not None and total == len(usrids) and aggregate['leaves'] == 0:
+        return total, []
+    if total is not None and total > STREAM_MIN_POSTS:
+        posters = member.get_posters(usridlink, phase)
+        known = delta.known_ids(usrids)
+        return len(posters), _Stream(phase, [usrid for usrid in posters if usrid not in known])
+    return delta.phase_delta(get_phase(usridlink, phase), usrids)
+
+
+def _size(rows):
+    # bytes held by the values of a snapshot, the aggregate counts as none
+    if isinstance(rows, dict):
+        return 0
+    size = 0
+    for usrid, value in rows:
+        if isinstance(value, str):
+            size = size + len(value)
+    return size
+
+
+def _cached(usridlink, phase, load):
+    global _local_size
+    now = time.time()
+    version = notify.channel.version(usridlink)
+
+    with _local_lock:
+        cached = _local.pop((usridlink, phase), None)
+        if cached is not None:
+            if cached[0] == version and cached[1] > now:
+                _local[(usridlink, phase)] = cached
+                return cached[2]
+            _local_size = _local_size - cached[3]
+
+    rows = None
+    if version is not None:
+        rows = memcache.get(_snapshot_key(usridlink, phase, version))
+
+    if rows is None:
+        rows = load(usridlink, phase)
+        if version is not None:
+            try:
+                memcache.set(_snapshot_key(usridlink, phase, version), rows, time=SNAPSHOT_TTL)
+            except ValueError:
+                pass  # snapshot of a large group is over the memcache value limit
+
+    size = _size(rows)
+    if version is not None and size <= SNAPSHOT_MAX_BYTES:
+        with _local_lock:
+            old = _local.pop((usridlink, phase), None)
+            if old is not None:
+                _local_size = _local_size - old[3]
+            _local[(usridlink, phase)] = (version, now + SNAPSHOT_TTL, rows, size)
+            _local_size = _local_size + size
+            while _local_size > LOCAL_MAX_BYTES:
+                _local_size = _local_size - _local.popitem(last=False)[1][3]
+    return rows
+
+
+def poll_phase(usridlink, usrids, phase, wait):
+    # phase totals and deltas for the group; when long-polling, hold until
+    # there is a post the client lacks or the total differs from the
+    # number of ids it knows
+    if usridlink == None:
+        return delta.phase_delta([], usrids)  # not linked to a group yet
+    deadline = time.time() + wait
+    while True:
+        version = notify.channel.version(usridlink)
+        total, entries = phase_delta(usridlink, usrids, phase)
+        remain = deadline - time.time()
+        if entries or total != len(usrids) or remain <= 0 or version is None:
+            return total, entries
+        # wake up at least when the snapshot expires, in case an invalidation was lost
+        notify.channel.wait(usridlink, version, min(remain, SNAPSHOT_TTL))
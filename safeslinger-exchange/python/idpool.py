@@ -0,0 +1,105 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import txn
+
+
+# don't assign 1-10 so that users won't confuse the # of users with the grouping id
+MIN_USR_ID = 11
+MAX_USR_ID = 9999
+
+# random picks tried in one range before widening to the next range
+MAX_PROBES = 16
+
+LIVE_COUNT_KEY = 'idpool:live'
+
+
+class UserIdSlot(db.Model):
+    # reservation of a single usr_id, the key name is the id itself
+    inserted = db.DateTimeProperty(auto_now_add=True)
+
+
+def slot_key(usrid):
+    return db.Key.from_path('UserIdSlot', str(usrid))
+
+
+def range_max(num):
+    # we know how many are left in the current range
+    if num >= 999:
+        return 9999
+    elif num >= 99:
+        return 999
+    else:
+        return 99
+
+
+def live_count():
+    # number of reserved ids, kept in memcache and rebuilt only after eviction
+    num = memcache.get(LIVE_COUNT_KEY)
+    if num is None:
+        num = UserIdSlot.all(keys_only=True).count(limit=MAX_USR_ID)
+        memcache.add(LIVE_COUNT_KEY, num)
+    return num
+
+
+def _reserve(usrid):
+    key = slot_key(usrid)
+    if db.get(key) is not None:
+        return False
+    UserIdSlot(key=key).put()
+    return True
+
+
+def allocate():
+    # pick a random free usr_id, reserving it transactionally by key
+    maxUsers = range_max(live_count())
+    r = random.SystemRandom()
+    while True:
+        for i in xrange(MAX_PROBES):
+            usrid = r.randint(MIN_USR_ID, maxUsers)
+            try:
+                reserved = txn.run(_reserve, usrid)
+            except db.TransactionFailedError:
+                reserved = False  # contended, most likely taken by another request
+            if reserved:
+                # only counts an existing total, a missing one is rebuilt by live_count
+                memcache.incr(LIVE_COUNT_KEY)
+                return usrid
+            logging.info("found duplicate usr_id=" + str(usrid) + ", retrying...")
+
+        # current range looks full, move up to the next one
+        if maxUsers >= MAX_USR_ID:
+            return None
+        maxUsers = range_max(maxUsers)
+
+
+def release(keys):
+    # free reserved slots, usually during cleanup
+    if keys:
+        db.delete(keys)
+        memcache.decr(LIVE_COUNT_KEY, len(keys))
@@ -29,9 +29,11 @@ class MainHandler(webapp.RequestHandler):
     def get(self):
         self.response.out.write('<html><body>')
 
+application = webapp.WSGIApplication([('/', MainHandler)],
+                                     debug=True)
+
+
 def main():
-    application = webapp.WSGIApplication([('/', MainHandler)],
-                                         debug=True)
     util.run_wsgi_app(application)
 
 
@@ -20,17 +20,324 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import hashlib
+
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
+import delta
+import txn
+
+
+# keys per batch get when reading a group, bounds memory and rpc size for
+# large groups
+PAGE_SIZE = 500
+
+# group log updates left to a task when the index stays contended
+LOG_POSTS_URL = '/cron/logposts'
+
+# phases counted in the group aggregates
+TOTAL_PHASES = ('commitment', 'data', 'signature', 'match')
+
 
 class Member(db.Model):
+    # lightweight membership record, phase values are kept in Payload
     usr_id_link = db.IntegerProperty()
     usr_id = db.IntegerProperty(required=True)
-    commitment = db.BlobProperty(required=True)
-    data = db.BlobProperty()
-    signature = db.BlobProperty()
-    match = db.BlobProperty()
     inserted = db.DateTimeProperty(auto_now_add=True)
     client_ver = db.IntegerProperty(required=True)
-    key_node = db.BlobProperty()
 
+
+class Payload(db.Model):
+    # one phase value (commitment, data, signature, match or key_node) of one
+    # member, the key name is '<phase>:<usr_id>'
+    value = db.BlobProperty()
+    inserted = db.DateTimeProperty(auto_now_add=True)
+
+
+class GroupIndex(db.Model):
+    # members linked to a group, the key name is the usr_id_link
+    usr_ids = db.ListProperty(int, indexed=False)
+    client_vers = db.ListProperty(int, indexed=False)
+    seq = db.IntegerProperty(default=0)
+    # members that have fetched every match, the group is done when all have
+    fetched = db.ListProperty(int, indexed=False)
+    # aggregates kept up to date by every join, leave and post, so a poll
+    # needs no scan of the members; posted holds the counted '<phase>:<usr_id>'
+    posted = db.StringListProperty(indexed=False)
+    commitment_total = db.IntegerProperty(default=0)
+    data_total = db.IntegerProperty(default=0)
+    signature_total = db.IntegerProperty(default=0)
+    match_total = db.IntegerProperty(default=0)
+    low_client = db.IntegerProperty(default=0)
+    # members removed from the group, once any has left a phase total no
+    # longer tells whether a client already has every post
+    leaves = db.IntegerProperty(default=0)
+    inserted = db.DateTimeProperty(auto_now_add=True)
+
+
+class GroupEvent(db.Model):
+    # one post to a group, a child of its GroupIndex keyed by sequence number
+    phase = db.StringProperty(required=True)
+    usr_id = db.IntegerProperty(required=True)
+    seq = db.IntegerProperty(required=True)
+    inserted = db.DateTimeProperty(auto_now_add=True)
+
+
+def member_key(usrid):
+    # members are keyed by usr_id so lookups are a strongly consistent get
+    return db.Key.from_path('Member', str(usrid))
+
+
+def get_member(usrid):
+    return Member.get_by_key_name(str(usrid))
+
+
+def get_members(usrids):
+    # one batch get, None for ids that do not exist
+    return db.get([member_key(usrid) for usrid in usrids])
+
+
+def payload_key(phase, usrid):
+    return db.Key.from_path('Payload', '%s:%d' % (phase, usrid))
+
+
+def get_payload(phase, usrid):
+    payload = db.get(payload_key(phase, usrid))
+    if payload is None:
+        return None
+    return payload.value
+
+
+def group_key(usridlink):
+    return db.Key.from_path('GroupIndex', str(usridlink))
+
+
+def _log(index, phase, usrid):
+    # next entry of the group's event log, put it with the index in the
+    # group's transaction
+    index.seq = index.seq + 1
+    return GroupEvent(parent=index, key_name=str(index.seq), phase=phase, usr_id=usrid, seq=index.seq)
+
+
+def _count(index, phase, usrid):
+    # first post of a phase by a member adds to the phase total
+    name = '%s:%d' % (phase, usrid)
+    if phase in TOTAL_PHASES and name not in index.posted:
+        index.posted.append(name)
+        setattr(index, phase + '_total', getattr(index, phase + '_total') + 1)
+
+
+def _uncount(index, usrid):
+    for phase in TOTAL_PHASES:
+        name = '%s:%d' % (phase, usrid)
+        if name in index.posted:
+            index.posted.remove(name)
+            setattr(index, phase + '_total', getattr(index, phase + '_total') - 1)
+
+
+def _live(usridlink, usrids):
+    # true when any of the ids is still a member linked to the group
+    for mem in get_members(usrids):
+        if mem is not None and mem.usr_id_link == usridlink:
+            return True
+    return False
+
+
+def _join(usridlink, usrid, client_ver, stale):
+    index = db.get(group_key(usridlink))
+    if index is not None and index.inserted == stale:
+        # the link belonged to an earlier exchange whose members have all
+        # expired, drop its log and start over; sequence numbers keep
+        # counting up so ones cached by clients stay valid
+        db.delete(list(GroupEvent.all(keys_only=True).ancestor(index)))
+        index = GroupIndex(key=group_key(usridlink), seq=index.seq)
+    if index is None:
+        index = GroupIndex(key=group_key(usridlink))
+    if usrid in index.usr_ids:
+        i = index.usr_ids.index(usrid)
+        if index.client_vers[i] == client_ver:
+            return None  # already linked
+        index.client_vers[i] = client_ver
+        index.low_client = delta.lowest_version(zip(index.usr_ids, index.client_vers))
+        index.put()
+    else:
+        index.usr_ids.append(usrid)
+        index.client_vers.append(client_ver)
+        index.low_client = delta.lowest_version(zip(index.usr_ids, index.client_vers))
+        # the member's commitment becomes visible to the group
+        _count(index, 'commitment', usrid)
+        event = _log(index, 'commitment', usrid)
+        db.put([index, event])
+    return index.seq
+
+
+def _leave(usridlink, usrids):
+    index = db.get(group_key(usridlink))
+    if index is None:
+        return
+    left = False
+    for usrid in usrids:
+        if usrid in index.usr_ids:
+            i = index.usr_ids.index(usrid)
+            del index.usr_ids[i]
+            del index.client_vers[i]
+            _uncount(index, usrid)
+            index.leaves = index.leaves + 1
+            left = True
+    if left:
+        index.low_client = delta.lowest_version(zip(index.usr_ids, index.client_vers))
+        index.put()
+
+
+def _log_posts(usridlink, posts):
+    index = db.get(group_key(usridlink))
+    if index is None:
+        return None
+    entities = []
+    for phase, usrid in posts:
+        _count(index, phase, usrid)
+        entities.append(_log(index, phase, usrid))
+    entities.append(index)
+    db.put(entities)
+    return index.seq
+
+
+def log_posts(usridlink, posts):
+    # count and log (phase, usr_id) posts on the group's index, the only
+    # write members of a group contend on; returns the new sequence number
+    # of the group or None
+    seq = None
+    for i in xrange(0, len(posts), PAGE_SIZE):
+        seq = txn.run(_log_posts, usridlink, posts[i:i + PAGE_SIZE])
+    return seq
+
+
+def post_payloads(usridlink, posts):
+    # store (phase, usr_id, value) posts, then log them to the group. each
+    # payload is written on its own so the member's post always lands; when
+    # the index stays contended the log update is left to a task and None
+    # is returned, otherwise the new sequence number of the group
+    for i in xrange(0, len(posts), PAGE_SIZE):
+        db.put([Payload(key=payload_key(phase, usrid), value=value) for phase, usrid, value in posts[i:i + PAGE_SIZE]])
+    if usridlink == None:
+        return None
+    logged = [(phase, usrid) for phase, usrid, value in posts]
+    try:
+        return log_posts(usridlink, logged)
+    except db.TransactionFailedError:
+        taskqueue.add(url=LOG_POSTS_URL, params={
+            'link': usridlink,
+            'post': ['%s:%d' % post for post in logged]})
+        return None
+
+
+def join_group(usridlink, usrid, client_ver):
+    # an index none of whose members are live is left over from an earlier
+    # exchange, checked outside the transaction and rebuilt by _join if it
+    # is still the same index
+    stale = None
+    index = db.get(group_key(usridlink))
+    if index is not None and usrid not in index.usr_ids and not _live(usridlink, index.usr_ids):
+        stale = index.inserted
+    return txn.run(_join, usridlink, usrid, client_ver, stale)
+
+
+def leave_group(usridlink, usrid):
+    txn.run(_leave, usridlink, [usrid])
+
+
+def expire_members(members):
+    # remove expired members from their groups and delete their payloads,
+    # then the members; the caller frees their ids last so a reused id
+    # never finds anything of its previous owner
+    links = {}
+    for mem in members:
+        if mem.usr_id_link != None:
+            links.setdefault(mem.usr_id_link, []).append(mem.usr_id)
+    for usridlink, usrids in links.items():
+        txn.run(_leave, usridlink, usrids)
+    db.delete([payload_key(phase, mem.usr_id) for mem in members for phase in delta.PHASE_FIELDS.values()])
+    db.delete([mem.key() for mem in members])
+
+
+def _fetch_done(usridlink, usrid):
+    index = db.get(group_key(usridlink))
+    if index is None or usrid in index.fetched or usrid not in index.usr_ids:
+        return False
+    index.fetched.append(usrid)
+    index.put()
+    return set(index.usr_ids) <= set(index.fetched)
+
+
+def fetch_done(usridlink, usrid):
+    # record that the member has fetched the final phase, true only for the
+    # call that completes the group
+    return txn.run(_fetch_done, usridlink, usrid)
+
+
+def get_aggregate(usridlink):
+    # phase totals and the lowest client version of the group, one get
+    index = None
+    if usridlink != None:
+        index = db.get(group_key(usridlink))
+    aggregate = {'low_client': 0, 'leaves': 0}
+    for phase in TOTAL_PHASES:
+        aggregate[phase] = 0
+        if index is not None:
+            aggregate[phase] = getattr(index, phase + '_total')
+    if index is not None:
+        aggregate['low_client'] = index.low_client
+        aggregate['leaves'] = index.leaves
+    return aggregate
+
+
+def get_phase(usridlink, phase):
+    # (usr_id, value) for every member of the group, reading only the
+    # payloads of the requested phase
+    index = db.get(group_key(usridlink))
+    if index is None:
+        return []
+    return list(iter_payloads(phase, index.usr_ids))
+
+
+def get_posters(usridlink, phase):
+    # ids of the members that posted a counted phase, from the index alone
+    index = db.get(group_key(usridlink))
+    if index is None:
+        return []
+    prefix = phase + ':'
+    return [int(name[len(prefix):]) for name in index.posted if name.startswith(prefix)]
+
+
+def iter_payloads(phase, usrids):
+    # (usr_id, value) for each id, fetched a page of keys at a time
+    for i in xrange(0, len(usrids), PAGE_SIZE):
+        page = usrids[i:i + PAGE_SIZE]
+        payloads = db.get([payload_key(phase, usrid) for usrid in page])
+        for usrid, payload in zip(page, payloads):
+            if payload is None:
+                yield usrid, None
+            else:
+                yield usrid, payload.value
+
+
+class Commitment(db.Model):
+    # digest index of posted commitments, the key name is the sha-256 of the commitment
+    inserted = db.DateTimeProperty(auto_now_add=True)
+
+
+def commitment_key(commitment):
+    return db.Key.from_path('Commitment', hashlib.sha256(str(commitment)).hexdigest())
+
+
+def _claim(key):
+    if db.get(key) is not None:
+        return False
+    Commitment(key=key).put()
+    return True
+
+
+def claim_commitment(commitment):
+    # each commitment must be unique, false when it was already posted
+    return txn.run(_claim, commitment_key(commitment))
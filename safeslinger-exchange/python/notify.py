@@ -0,0 +1,102 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+# longest a sync request may be held waiting for a group change
+MAX_WAIT = 20
+# memcache polling starts quick and backs off so a held request costs a
+# few dozen gets rather than one every quarter second
+POLL_INTERVAL = 0.25
+POLL_INTERVAL_MAX = 2
+
+
+def wait_seconds(value):
+    # long-poll time requested by the client, bounded by MAX_WAIT
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, min(wait, MAX_WAIT))
+
+
+class MemcacheChannel(object):
+    # group change versions shared by all instances through memcache
+
+    def _key(self, usridlink):
+        return 'grp:ver:%d' % usridlink
+
+    def version(self, usridlink):
+        version = memcache.get(self._key(usridlink))
+        if version is None:
+            # start from the clock so a reset counter won't repeat old versions
+            version = memcache.incr(self._key(usridlink), initial_value=int(time.time() * 1000))
+        return version
+
+    def publish(self, usridlink):
+        memcache.incr(self._key(usridlink), initial_value=int(time.time() * 1000))
+
+    def wait(self, usridlink, version, timeout):
+        deadline = time.time() + timeout
+        interval = POLL_INTERVAL
+        while time.time() < deadline:
+            if memcache.get(self._key(usridlink)) != version:
+                return True
+            time.sleep(min(interval, max(0, deadline - time.time())))
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+        return False
+
+
+class LocalChannel(object):
+    # in-process stand-in for MemcacheChannel, lets the long-poll path be
+    # exercised without App Engine services; waiters on one instance only
+    # see posts handled by that same instance
+
+    def __init__(self):
+        self._versions = {}
+        self._changed = threading.Condition()
+
+    def version(self, usridlink):
+        with self._changed:
+            return self._versions.get(usridlink, 0)
+
+    def publish(self, usridlink):
+        with self._changed:
+            self._versions[usridlink] = self._versions.get(usridlink, 0) + 1
+            self._changed.notify_all()
+
+    def wait(self, usridlink, version, timeout):
+        deadline = time.time() + timeout
+        with self._changed:
+            while self._versions.get(usridlink, 0) == version:
+                remain = deadline - time.time()
+                if remain <= 0:
+                    return False
+                self._changed.wait(remain)
+        return True
+
+
+channel = MemcacheChannel()
@@ -0,0 +1,228 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import struct
+import time
+
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+import codec
+import delta
+import eventlog
+import eviction
+import groupcache
+import member
+import notify
+import syncUsers
+
+
+class SyncBatch(webapp.RequestHandler):
+    # several sync phases in one round trip, the request carries for each
+    # phase: phase id, known id count, known ids, post length, post data.
+    # the users phase post is the 4 byte usr_id_link to commit to, the key
+    # nodes phase post is the target usr_id followed by the key node.
+
+    def post(self):
+        self.response.headers.add_header("Access-Control-Allow-Origin", "*")
+
+        STR_VERSERVER = '01060000'
+        INT_VERCLIENT = 0x01060000
+        STR_VERCLIENT = '1.6'
+
+        if not os.environ.has_key('HTTPS'):
+            self.resp_simple(0, 'HTTPS environment variable not found')
+            return
+
+        if not os.environ.has_key('CURRENT_VERSION_ID'):
+            self.resp_simple(0, 'CURRENT_VERSION_ID environment variable not found')
+            return
+
+        HTTPS = os.environ.get('HTTPS', 'off')
+        CURRENT_VERSION_ID = os.environ.get('CURRENT_VERSION_ID', STR_VERSERVER)
+
+        # SSL must be enabled
+        if HTTPS.__str__() != 'on':
+            self.resp_simple(0, 'Secure socket required.')
+            return
+
+        minlen = 4 + 4 + 4
+
+        # get the data from the post
+        self.response.headers['Content-Type'] = 'application/octet-stream'
+        data = self.request.body
+
+        size = str.__len__(data)
+
+        if size < minlen:
+            self.resp_simple(0, 'Request was formatted incorrectly.')
+            return
+
+        # unpack all incoming data
+        server = int(CURRENT_VERSION_ID[0:8], 16)
+        reader = codec.Reader(data)
+        client = reader.read_int()
+        usrid = reader.read_int()
+        numPhase = reader.read_int()
+
+        phases = []
+        while numPhase > len(phases):
+            phase = reader.read_int()
+            numEntry = reader.read_int()
+            usrids = reader.read_ids(numEntry)
+            lenPost = reader.read_int()
+            if phase not in delta.PHASE_FIELDS or lenPost < 0 or lenPost > reader.remaining():
+                self.resp_simple(0, 'Request was formatted incorrectly.')
+                return
+            # users and key nodes posts start with a 4 byte usr_id
+            if 0 < lenPost < 4 and phase in (delta.PHASE_USERS, delta.PHASE_KEYNODES):
+                self.resp_simple(0, 'Request was formatted incorrectly.')
+                return
+            newVal = None
+            if lenPost > 0:
+                newVal = reader.read_blob(lenPost)
+            phases.append((phase, usrids, newVal))
+
+        # client version check
+        if client < INT_VERCLIENT:
+            self.resp_simple(0, ('Client version mismatch; %s required.  Download latest client release first.' % STR_VERCLIENT))
+            return
+
+        # verify you have an existing user
+        mem = member.get_member(usrid)
+        if mem is None:
+            self.resp_simple(0, ' user %i does not exist' % (usrid))
+            return
+
+        # apply all posts before reading the group, a new link is stored
+        # first so the other posts are logged to the group being joined
+        posts = []
+        links = set()
+        usridlink = None
+        for phase, usrids, newVal in phases:
+            field = delta.PHASE_FIELDS[phase]
+            if newVal is not None:
+                if phase == delta.PHASE_USERS:
+                    usridlink = struct.unpack('!i', newVal[0:4])[0]
+                elif phase == delta.PHASE_KEYNODES:
+                    usridpost = struct.unpack('!i', newVal[0:4])[0]
+                    if usridpost == usrid:
+                        mem_other = mem
+                    else:
+                        mem_other = member.get_member(usridpost)
+                    if mem_other is None:
+                        self.resp_simple(0, ' user %i does not exist for update' % (usridpost))
+                        return
+                    posts.append((mem_other, field, usridpost, newVal[4:]))
+                else:
+                    posts.append((mem, field, usrid, newVal))
+
+            # not posting, one must exist
+            elif phase != delta.PHASE_KEYNODES:
+                if member.get_payload(field, usrid) == None:
+                    self.resp_simple(0, 'Request was formatted incorrectly.')
+                    return
+
+        if usridlink is not None:
+            if not syncUsers.link_member(mem, usridlink):
+                self.resp_simple(0, 'Unable to update user.')
+                return
+
+        # one log update per group for the payload posts
+        grouped = {}
+        for target, field, usridpost, value in posts:
+            grouped.setdefault(target.usr_id_link, []).append((field, usridpost, value))
+        for usridlink, groupPosts in grouped.items():
+            seq = member.post_payloads(usridlink, groupPosts)
+            eventlog.published(usridlink, seq)
+            links.add(usridlink)
+
+        for usridlink in links:
+            groupcache.invalidate(usridlink)
+
+        # every phase reads only its own payloads for the group. when
+        # long-polling, hold until one phase has a post the client lacks or
+        # a total that differs from the number of ids it knows.
+        usridlink = mem.usr_id_link
+        wait = notify.wait_seconds(self.request.GET.get('wait'))
+        deadline = time.time() + wait
+        while True:
+            version = None
+            if usridlink != None:
+                version = notify.channel.version(usridlink)
+
+            results = {}
+            changed = False
+            for phase, usrids, newVal in phases:
+                if phase != delta.PHASE_KEYNODES:
+                    total, entries = groupcache.phase_delta(usridlink, usrids, delta.PHASE_FIELDS[phase])
+                    results[phase] = (total, entries)
+                    if entries or total != len(usrids):
+                        changed = True
+
+            remain = deadline - time.time()
+            if changed or remain <= 0 or version is None:
+                break
+            notify.channel.wait(usridlink, version, min(remain, groupcache.SNAPSHOT_TTL))
+
+        # each phase is written as it is packed, large phases a page at a time
+        out = self.response.out
+        out.write(struct.pack('!ii', server, len(phases)))
+        for phase, usrids, newVal in phases:
+            if phase == delta.PHASE_KEYNODES:
+                # node data for the requesting user
+                key_node = member.get_payload('key_node', usrid)
+                if key_node != None:
+                    length = str.__len__(key_node)
+                    out.write(struct.pack('!iii%ds' % length, phase, 1, length, key_node))
+                else:
+                    out.write(struct.pack('!ii', phase, 0))
+                continue
+
+            total, entries = results[phase]
+            if phase == delta.PHASE_USERS:
+                low_client = groupcache.lowest_version(usridlink)
+                header = (phase, low_client, total, len(entries))
+            else:
+                header = (phase, total, len(entries))
+            codec.write_delta(out, header, entries)
+
+        # the group is deleted early once everyone has all matches
+        if delta.PHASE_MATCH in results:
+            eviction.match_fetched(usridlink, usrid, results[delta.PHASE_MATCH][0])
+
+    def resp_simple(self, code, msg):
+        self.response.out.write('%s%s' % (struct.pack('!i', code), msg))
+
+
+application = webapp.WSGIApplication([('/syncBatch', SyncBatch),
+                                 ],
+                                 debug=True)
+
+
+def main():
+    util.run_wsgi_app(application)
+
+
+if __name__ == '__main__':
+    main()
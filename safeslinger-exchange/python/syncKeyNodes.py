@@ -26,6 +26,9 @@ import struct
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 
+import codec
+import eventlog
+import groupcache
 import member
 
 
@@ -68,17 +71,26 @@ class SyncKeyNodes(webapp.RequestHandler):
          
         # unpack all incoming data
         server = int(CURRENT_VERSION_ID[0:8], 16)
-        client = (struct.unpack("!i", data[0:4]))[0]
-        usrid = (struct.unpack("!i", data[4:8]))[0]
-        data = data[8:]
-        expectedsize = 4 + 4
+        reader = codec.Reader(data)
+        client = reader.read_int()
+        usrid = reader.read_int()
 
+        # a single (usridpost, size, node) post, or a negative count followed
+        # by that many of them
+        posts = []
         postKeyNodes = False
-        if size > expectedsize:
-            usridpost = (struct.unpack("!i", data[0:4]))[0]
-            sizeData = (struct.unpack("!i", data[4:8]))[0]
-            key_node = (struct.unpack(str(sizeData) + "s", data[8:8 + sizeData]))[0]
-            postKeyNodes = True
+        if reader.remaining() > 0:
+            numPost = reader.read_int()
+            if numPost >= 0:
+                # the single form is answered with the node it posted
+                postKeyNodes = True
+                usridpost = numPost
+                sizeData = reader.read_int()
+                posts.append((usridpost, reader.read_blob(sizeData)))
+            for i in xrange(-numPost):
+                usridpost = reader.read_int()
+                sizeData = reader.read_int()
+                posts.append((usridpost, reader.read_blob(sizeData)))
  
         # client version check
         if client < INT_VERCLIENT:
@@ -86,45 +98,40 @@ class SyncKeyNodes(webapp.RequestHandler):
             return        
 
         # verify you have an existing group
-        query = member.Member.all()
-        query.filter('usr_id =', usrid)
-        num = query.count()
+        mem = member.get_member(usrid)
         
         # requesting user exists
-        if num == 1:
-            mem = query.get()
+        if mem is not None:
             
             # verify...
-            if postKeyNodes:
-                query = member.Member.all()
-                query.filter('usr_id =', usridpost)
-                num = query.count()
-                # user exists for updating node
-                if num == 1:
-                    mem_other = query.get()
-                    mem_other.key_node = key_node
-                    mem_other.put()
-                    key = mem_other.key()
-                    if not key.has_id_or_name():
-                        self.resp_simple(0, 'Unable to update user.')
-                        return       
-                else:
-                    self.resp_simple(0, ' user %i does not exist for update' % (usridpost))
-                    return   
+            if posts:
+                # all targets in one batch get
+                targets = member.get_members([usridpost for usridpost, node in posts])
+                grouped = {}
+                for (usridpost, node), mem_other in zip(posts, targets):
+                    # user exists for updating node
+                    if mem_other is None:
+                        self.resp_simple(0, ' user %i does not exist for update' % (usridpost))
+                        return
+                    grouped.setdefault(mem_other.usr_id_link, []).append(('key_node', usridpost, node))
+                # one put per group, usually one for the whole batch
+                for usridlink, groupPosts in grouped.items():
+                    seq = member.post_payloads(usridlink, groupPosts)
+                    eventlog.published(usridlink, seq)
+                    groupcache.invalidate(usridlink)
+                if postKeyNodes:
+                    key_node = posts[0][1]
                                 
-            # version
-            self.response.out.write('%s' % struct.pack('!i', server))
-
             # node data
-            mem = query.get()
-            if mem.key_node != None:
-                # n results
-                self.response.out.write('%s' % struct.pack('!i', num))
-                length = str.__len__(mem.key_node)
-                self.response.out.write('%s%s' % (struct.pack('!i', length), mem.key_node))                    
+            if not postKeyNodes:
+                key_node = member.get_payload('key_node', usrid)
+            if key_node != None:
+                # version, n results and node in one write
+                length = str.__len__(key_node)
+                self.response.out.write(struct.pack('!iii%ds' % length, server, 1, length, key_node))
             else:
-                # n results
-                self.response.out.write('%s' % struct.pack('!i', 0))
+                # version, n results
+                self.response.out.write(struct.pack('!ii', server, 0))
 
         
         else:
@@ -136,11 +143,13 @@ class SyncKeyNodes(webapp.RequestHandler):
         self.response.out.write('%s%s' % (struct.pack('!i', code), msg))
 
 
+application = webapp.WSGIApplication([('/syncKeyNodes', SyncKeyNodes),
+                                  ('/syncKeyNodes_1_3', SyncKeyNodes),
+                                 ],
+                                 debug=True)
+
+
 def main():
-    application = webapp.WSGIApplication([('/syncKeyNodes', SyncKeyNodes),
-                                      ('/syncKeyNodes_1_3', SyncKeyNodes),
-                                     ],
-                                     debug=True)
     util.run_wsgi_app(application)
 
 
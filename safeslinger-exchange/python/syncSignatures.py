@@ -26,7 +26,11 @@ import struct
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 
+import codec
+import eventlog
+import groupcache
 import member
+import notify
 
 
 class SyncSignatures(webapp.RequestHandler):
@@ -68,20 +72,12 @@ class SyncSignatures(webapp.RequestHandler):
          
         # unpack all incoming data
         server = int(CURRENT_VERSION_ID[0:8], 16)
-        client = (struct.unpack("!i", data[0:4]))[0]
-        data = data[4:]
+        reader = codec.Reader(data)
+        client = reader.read_int()
 
-        # unpack all incoming data
-        usrids = []
-        usrid = (struct.unpack("!i", data[0:4]))[0]
-        numEntry = (struct.unpack("!i", data[4:8]))[0]
-        data = data[8:]
-        expectedsize = 4 + 4 + 4 + (4 * numEntry)
- 
-        # append enough entries to hold the expected data
-        while numEntry > len(usrids):
-            usrids.append(struct.unpack("!i", data[0:4])[0])
-            data = data[4:]
+        usrid = reader.read_int()
+        numEntry = reader.read_int()
+        usrids = reader.read_ids(numEntry)
  
         # client version check
         if client < INT_VERCLIENT:
@@ -89,72 +85,43 @@ class SyncSignatures(webapp.RequestHandler):
             return        
             
         postSig = False
-        if size > expectedsize:
-            newVal = data[0:]
+        if reader.remaining() > 0:
+            newVal = reader.read_rest()
             postSig = True
         
         # verify you have an existing group
-        query = member.Member.all()
-        query.filter('usr_id =', usrid)
-        num = query.count()
+        mem = member.get_member(usrid)
     
         # user exists
-        if num == 1:
-            mem = query.get()
+        if mem is not None:
             usridlink = mem.usr_id_link
 
             # post signature...
             if postSig:                
-                mem.signature = newVal
-                mem.put()
-                key = mem.key()
-                if not key.has_id_or_name():
-                    self.resp_simple(0, 'Unable to update user.')
-                    return
+                seq = member.post_payloads(usridlink, [('signature', usrid, newVal)])
+                eventlog.published(usridlink, seq)
+                groupcache.invalidate(usridlink)
 
             # not posting signature, one must exist
             else:
-                if mem.signature == None:
+                if member.get_payload('signature', usrid) == None:
                     self.resp_simple(0, 'Request was formatted incorrectly.')
                     return
             
             
-            # get the entries for the group
-            query = member.Member.all()
-            query.filter('usr_id_link =', usridlink)
-            mems = query.fetch(1000)
-    
-            # version
-            self.response.out.write('%s' % struct.pack('!i', server))
-
-            # grand total
-            num = 0
-            for mem in mems:
-                if mem.signature != None:
-                    num = num + 1
-            
-            self.response.out.write('%s' % struct.pack('!i', num))
-    
-            # add delta ids total
-            num = 0
-            for mem in mems:
-                posted = False
-                for known in usrids:
-                    if known == mem.usr_id:
-                        posted = True                    
-                if (not posted) & (mem.signature != None):
-                    num = num + 1
-            
-            self.response.out.write('%s' % struct.pack('!i', num))
-    
-            for mem in mems:
-                posted = False
-                for known in usrids:
-                    if known == mem.usr_id:
-                        posted = True                    
-                if (not posted) & (mem.signature != None):
-                    length = str.__len__(mem.signature)
-                    self.response.out.write('%s%s' % (struct.pack('!ii', mem.usr_id, length), mem.signature))
+            # get the entries for the group, held until a change when long-polling
+            wait = notify.wait_seconds(self.request.GET.get('wait'))
+            since = eventlog.since_arg(self.request.GET.get('since'))
+            if since is not None:
+                # only posts logged after the client's sequence number
+                seq, entries = eventlog.poll_since(usridlink, 'signature', since, wait)
+                codec.write_delta(self.response.out, (server, seq, len(entries)), entries)
+                return
+
+            total, entries = groupcache.poll_phase(usridlink, usrids, 'signature', wait)
+
+            # version, totals and entries, one write per page
+            codec.write_delta(self.response.out, (server, total, len(entries)), entries)
         
         else:
             self.resp_simple(0, ' user %i does not exist' % (usrid))
@@ -165,11 +132,13 @@ class SyncSignatures(webapp.RequestHandler):
         self.response.out.write('%s%s' % (struct.pack('!i', code), msg))
 
 
+application = webapp.WSGIApplication([('/syncSignatures', SyncSignatures),
+                                  ('/syncSignatures_1_2', SyncSignatures),
+                                 ],
+                                 debug=True)
+
+
 def main():
-    application = webapp.WSGIApplication([('/syncSignatures', SyncSignatures),
-                                      ('/syncSignatures_1_2', SyncSignatures),
-                                     ],
-                                     debug=True)
     util.run_wsgi_app(application)
 
 
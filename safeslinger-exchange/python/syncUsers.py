@@ -20,13 +20,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import logging
 import os
 import struct
 
-from google.appengine.ext import webapp
+from google.appengine.ext import db, webapp
 from google.appengine.ext.webapp import util
 
+import codec
+import eventlog
+import groupcache
 import member
+import notify
 
 
 class SyncUsers(webapp.RequestHandler):
@@ -68,20 +73,13 @@ class SyncUsers(webapp.RequestHandler):
          
         # unpack all incoming data
         server = int(CURRENT_VERSION_ID[0:8], 16)
-        client = (struct.unpack("!i", data[0:4]))[0]
-        data = data[4:]
-
-        usrids = []
-        usrid = (struct.unpack("!i", data[0:4]))[0]
-        usridlink = (struct.unpack("!i", data[4:8]))[0]
-        numEntry = (struct.unpack("!i", data[8:12]))[0]
-        data = data[12:]
-        expectedsize = 4 + 4 + 4 + 4 + (4 * numEntry)
-
-        # append enough entries to hold the expected data
-        while numEntry > len(usrids):
-            usrids.append(struct.unpack("!i", data[0:4])[0])
-            data = data[4:]
+        reader = codec.Reader(data)
+        client = reader.read_int()
+
+        usrid = reader.read_int()
+        usridlink = reader.read_int()
+        numEntry = reader.read_int()
+        usrids = reader.read_ids(numEntry)
  
         # client version check
         if client < INT_VERCLIENT:
@@ -89,76 +87,39 @@ class SyncUsers(webapp.RequestHandler):
             return        
 
         postSig = False
-        if size > expectedsize:
+        if reader.remaining() > 0:
             postSig = True
                     
         # verify you have an existing user
-        query = member.Member.all()
-        query.filter('usr_id =', usrid)
-        num = query.count()
+        mem = member.get_member(usrid)
         
         # user exists
-        if num == 1:
-            mem = query.get()
+        if mem is not None:
             
             # commit to group number
             if postSig:            
-                mem.usr_id_link = usridlink
-                mem.put()
-                key = mem.key()
-                if not key.has_id_or_name():
+                if not link_member(mem, usridlink):
                     self.resp_simple(0, 'Unable to update user.')
                     return
 
             # not posting signature, one must exist
             else:
-                if mem.commitment == None:
+                if member.get_payload('commitment', usrid) == None:
                     self.resp_simple(0, 'Request was formatted incorrectly.')
                     return
 
-            # get the entries for the group
-            query = member.Member.all()
-            query.filter('usr_id_link =', usridlink)
-            mems = query.fetch(1000)
-
-            # version
-            self.response.out.write('%s' % struct.pack('!i', server))
-
-            # lowest client version
-            q = member.Member.all()
-            q.filter('usr_id_link =', usridlink)
-            m = q.fetch(1000)
-            low_client = self.getLowestVersion(m)
-            self.response.out.write('%s' % struct.pack('!i', low_client))
-
-            # grand total
-            num = 0
-            for mem in mems:
-                if mem.commitment != None:
-                    num = num + 1
-            
-            self.response.out.write('%s' % struct.pack('!i', num))
-      
-            # add delta ids total
-            num = 0
-            for mem in mems:
-                posted = False
-                for known in usrids:
-                    if known == mem.usr_id:
-                        posted = True                    
-                if (not posted) & (mem.commitment != None):
-                    num = num + 1
-            
-            self.response.out.write('%s' % struct.pack('!i', num))
-    
-            for mem in mems:
-                posted = False
-                for known in usrids:
-                    if known == mem.usr_id:
-                        posted = True                    
-                if (not posted) & (mem.commitment != None):
-                    length = str.__len__(mem.commitment)
-                    self.response.out.write('%s%s' % (struct.pack('!ii', mem.usr_id, length), mem.commitment))
+            # get the entries for the group, held until a change when long-polling
+            wait = notify.wait_seconds(self.request.GET.get('wait'))
+            since = eventlog.since_arg(self.request.GET.get('since'))
+            if since is not None:
+                # only commitments logged after the client's sequence number
+                seq, entries = eventlog.poll_since(usridlink, 'commitment', since, wait)
+                low_client = groupcache.lowest_version(usridlink)
+                codec.write_delta(self.response.out, (server, low_client, seq, len(entries)), entries)
+                return
+
+            # version, lowest version, totals and entries, one write per page
+            write_commitments(self.response.out, (server,), usridlink, usrids, wait)
         
         else:
             self.resp_simple(0, ' user %i does not exist' % (usrid))
@@ -169,30 +130,50 @@ class SyncUsers(webapp.RequestHandler):
         self.response.out.write('%s%s' % (struct.pack('!i', code), msg))
     
 
-    def getLowestVersion(self, mems):
-        # get lowest available version
-        INT_VERCLIENT = 0x01060000
-        lowest = 0
-        for mem in mems:
-            if mem.client_ver != None:    
-                cur = mem.client_ver                                
-            else:
-                cur = INT_VERCLIENT  # default
-                
-            if lowest == 0:
-                lowest = cur  # needs a starting point
-            
-            if cur < lowest:
-                lowest = mem.client_ver                
-                
-        return lowest
-    
+def link_member(mem, usridlink):
+    # commit the member to a group, leaving any group it was linked to;
+    # false when it could not be stored or the group stayed contended
+    oldlink = mem.usr_id_link
+    mem.usr_id_link = usridlink
+    mem.put()
+    key = mem.key()
+    if not key.has_id_or_name():
+        return False
+    try:
+        seq = member.join_group(usridlink, mem.usr_id, mem.client_ver)
+    except db.TransactionFailedError:
+        mem.usr_id_link = oldlink
+        mem.put()
+        return False
+    eventlog.published(usridlink, seq)
+    groupcache.invalidate(usridlink)
+    if oldlink != None and oldlink != usridlink:
+        try:
+            member.leave_group(oldlink, mem.usr_id)
+        except db.TransactionFailedError:
+            # still listed by the old group until the member expires
+            logging.warning('unable to leave group %i, usr_id=%i' % (oldlink, mem.usr_id))
+        groupcache.invalidate(oldlink)
+    return True
+
+
+def write_commitments(out, header, usridlink, usrids, wait):
+    # header fields followed by the lowest version, totals and entries
+    total, entries = groupcache.poll_phase(usridlink, usrids, 'commitment', wait)
+
+    # lowest client version
+    low_client = groupcache.lowest_version(usridlink)
+
+    codec.write_delta(out, header + (low_client, total, len(entries)), entries)
+
+
+application = webapp.WSGIApplication([('/syncUsers', SyncUsers),
+                                  ('/syncUsers_1_2', SyncUsers),
+                                 ],
+                                 debug=True)
+
 
 def main():
-    application = webapp.WSGIApplication([('/syncUsers', SyncUsers),
-                                      ('/syncUsers_1_2', SyncUsers),
-                                     ],
-                                     debug=True)
     util.run_wsgi_app(application)
 
 
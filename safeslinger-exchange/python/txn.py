@@ -0,0 +1,73 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import os
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+# optimistic retries after a commit collision before the error is raised
+MAX_RETRIES = 4
+BACKOFF = 0.05  # seconds, doubled on each retry
+
+
+def _handler():
+    # counters are kept per request path, e.g. '/syncData'
+    return os.environ.get('PATH_INFO', '')
+
+
+def record(retries, elapsed, failed=False):
+    # per handler totals in memcache: commits, contention retries, failed
+    # transactions and commit latency in ms, read them from the memcache viewer
+    handler = _handler()
+    counters = {'retries': retries, 'latency_ms': int(elapsed * 1000)}
+    if failed:
+        counters['failed'] = 1
+    else:
+        counters['commits'] = 1
+    memcache.offset_multi(counters, key_prefix='txn:%s:' % handler, initial_value=0)
+    if retries > 0:
+        logging.warning('txn: %s contention, retries=%i, %.3f secs%s' % (handler, retries, elapsed, ' failed' if failed else ''))
+
+
+def run(func, *args, **kwargs):
+    # run func in a transaction, retrying collisions with a bounded and
+    # jittered backoff; pass xg=True for cross-group transactions
+    options = db.create_transaction_options(xg=kwargs.get('xg', False), retries=0)
+    start = time.time()
+    retries = 0
+    while True:
+        try:
+            result = db.run_in_transaction_options(options, func, *args)
+        except db.TransactionFailedError:
+            if retries >= MAX_RETRIES:
+                record(retries, time.time() - start, failed=True)
+                raise
+            retries += 1
+            time.sleep(BACKOFF * (2 ** (retries - 1)) * random.uniform(0.5, 1.5))
+            continue
+        record(retries, time.time() - start)
+        return result
@@ -28,6 +28,7 @@ from datetime import datetime
 from socket import socket, timeout, AF_INET, SOCK_STREAM
 from socket import error as socket_error
 from struct import pack, unpack
+import hashlib
 import sys
 import ssl
 import select
@@ -85,22 +86,51 @@ ERROR_RESPONSE_FORMAT = (
 
 TOKEN_LENGTH = 32
 ERROR_RESPONSE_LENGTH = 6
-SENT_BUFFER_QTY = 100000
+# recent notifications kept per connection for resending, an error-response
+# arrives within a round trip so this only has to cover a burst of sends
+SENT_BUFFER_QTY = 1000
 WAIT_WRITE_TIMEOUT_SEC = 10
 WAIT_READ_TIMEOUT_SEC = 0.1
+# a persistent connection keeps reading this long after a send, and again
+# after every resend, before the notification is reported sent
+WAIT_ERROR_RESPONSE_SEC = 0.5
 
 ER_STATUS = 'status'
 ER_IDENTIFER = 'identifier'
 
+# long-lived gateway connections of this instance, keyed by server and credential
+GATEWAY_POOL_MAX = 4
+_gateway_pool = collections.OrderedDict()
+_gateway_pool_lock = threading.Lock()
+
+def pooled_gateway_connection(use_sandbox, cert_file, key_file):
+    """
+    Returns the instance's persistent gateway connection for the server and
+    credential, creating it on first use. The TLS session is kept open
+    between notifications and re-established after idle timeouts or errors.
+    """
+    key = (use_sandbox, hashlib.sha1(cert_file + key_file).hexdigest())
+    with _gateway_pool_lock:
+        connection = _gateway_pool.pop(key, None)
+        if connection is None:
+            connection = GatewayConnection(use_sandbox=use_sandbox, cert_file=cert_file,
+                                           key_file=key_file, enhanced=True, persistent=True)
+        _gateway_pool[key] = connection
+        while len(_gateway_pool) > GATEWAY_POOL_MAX:
+            _, evicted = _gateway_pool.popitem(last=False)
+            evicted._disconnect()  # usually a replaced credential
+        return connection
+
 class APNs(object):
     """
     A class representing an Apple Push Notification service connection
     """
 
-    def __init__(self, use_sandbox=False, cert_file=None, key_file=None, enhanced=False):
+    def __init__(self, use_sandbox=False, cert_file=None, key_file=None, enhanced=False, pooled=False):
         """
         Set use_sandbox to True to use the sandbox (test) APNs servers.
-        Default is False.
+        Default is False. Set pooled to True to send through the instance's
+        persistent enhanced gateway connection for this credential.
         """
         super(APNs, self).__init__()
         self.use_sandbox = use_sandbox
@@ -109,6 +139,7 @@ class APNs(object):
         self._feedback_connection = None
         self._gateway_connection = None
         self.enhanced = enhanced
+        self.pooled = pooled
 
     @staticmethod
     def packed_uchar(num):
@@ -165,6 +196,8 @@ class APNs(object):
 
     @property
     def gateway_server(self):
+        if self.pooled:
+            return pooled_gateway_connection(self.use_sandbox, self.cert_file, self.key_file)
         if not self._gateway_connection:
             self._gateway_connection = GatewayConnection(
                 use_sandbox = self.use_sandbox,
@@ -396,7 +429,7 @@ class Frame(object):
         self.notification_data.append({'token':token_hex, 'payload':payload, 'identifier':identifier, 'expiry':expiry, "priority":priority})
 
     def get_notifications(self, gateway_connection):
-        notifications = list({'id': x['identifier'], 'message':gateway_connection._get_enhanced_notification(x['token'], x['payload'],x['identifier'], x['expiry'])} for x in self.notification_data)
+        notifications = list({'id': x['identifier'], 'token': x['token'], 'message':gateway_connection._get_enhanced_notification(x['token'], x['payload'],x['identifier'], x['expiry'])} for x in self.notification_data)
         return notifications
 
     def __str__(self):
@@ -462,16 +495,18 @@ class GatewayConnection(APNsConnection):
     A class that represents a connection to the APNs gateway server
     """
     
-    def __init__(self, use_sandbox=False, **kwargs):
+    def __init__(self, use_sandbox=False, persistent=False, **kwargs):
         super(GatewayConnection, self).__init__(**kwargs)
         self.server = (
             'gateway.push.apple.com',
             'gateway.sandbox.push.apple.com')[use_sandbox]
         self.port = 2195
-        if self.enhanced == True: #start error-response monitoring thread       
+        self.persistent = persistent
+        if self.enhanced == True: # error-responses are read on the sending thread
             self._last_activity_time = time.time()
             self._send_lock = threading.RLock()
             self._sent_notifications = collections.deque(maxlen=SENT_BUFFER_QTY)
+            self._response_listener = None
 
     def _get_notification(self, token_hex, payload):
         """
@@ -503,14 +538,19 @@ class GatewayConnection(APNsConnection):
             + payload_length_bin + payload_json)
         return notification
          
-    def send_notification(self, token_hex, payload, identifier=0, expiry=0):
+    def send_notification(self, token_hex, payload, identifier=0, expiry=0, retry=True):
         """
-        in enhanced mode, send_notification may return error response from APNs if any
+        in enhanced mode, send_notification may return error response from APNs if any.
+        with retry False a failed write returns 10 at once instead of backing off,
+        for callers that retry on their own.
+        a persistent connection waits WAIT_ERROR_RESPONSE_SEC for error-responses
+        before returning, resending what APNS dropped after a failed notification;
+        an error-response for an earlier notification goes to the response listener
         """
         if self.enhanced:
-            self._last_activity_time = time.time()
             message = self._get_enhanced_notification(token_hex, payload,
                                                            identifier, expiry)
+            notification = {'id': identifier, 'message': message, 'token': token_hex}
             timeout_sec = 2
             timeout_tot = 0
             i = 0
@@ -520,23 +560,29 @@ class GatewayConnection(APNsConnection):
                     with self._send_lock:
                         timeout_tot += timeout_sec
                         i += 1
+                        _error = 0
+                        if self.persistent:
+                            # pick up what arrived since the last send
+                            self._await_error_responses(identifier, 0)
+                            # apple drops idle connections without notice, start a fresh one
+                            if self.connection_alive and self._is_idle_timeout():
+                                self._disconnect()
+                        self._last_activity_time = time.time()
                         self.write(message)
-                        self._sent_notifications.append(dict({'id': identifier, 'message': message}))
-                        rlist, _, _ = select.select([self._connection()], [], [], WAIT_READ_TIMEOUT_SEC)
-                        if len(rlist) > 0: # there's some data from APNs
-                            self._socket.settimeout(0.1)
-                            buff = self.read(ERROR_RESPONSE_LENGTH)
-                            if len(buff) == ERROR_RESPONSE_LENGTH:
-                                command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
-                                if 8 == command: # there is error response from APNS
-                                    _logger.info("got error-response from APNS: %d" % status)
-                                _error = status
+                        self._sent_notifications.append(notification)
+                        if self.persistent:
+                            _error = self._await_error_responses(identifier, WAIT_ERROR_RESPONSE_SEC)
                         else:
-                            _logger.debug("Successfully Sent Notification to APNS.") #DEBUG
-                        self._disconnect()
+                            _error = self._await_error_responses(identifier, WAIT_READ_TIMEOUT_SEC)
+                            self._disconnect()
                     break
                 except socket_error as e:
                     _error = 10
+                    self._disconnect() # reconnect on the next attempt
+                    if not retry:
+                        _logger.warning("sending notification with id:" + str(identifier) + 
+                                        " to APNS failed: " + str(type(e)) + ": " + str(e))
+                        break
                     timeout_sec *= 2
                     _logger.exception("sending notification with id:" + str(identifier) + 
                                       " to APNS failed: " + str(type(e)) + ": " + str(e) + 
@@ -548,6 +594,88 @@ class GatewayConnection(APNsConnection):
             self.write(self._get_notification(token_hex, payload))
             return True
 
+    def _read_error_response(self, wait):
+        """
+        Returns (status, identifier) of an error-response received within
+        wait seconds, or None. A connection closed by APNS is dropped.
+        """
+        if not self.connection_alive:
+            return None
+        if not self._ssl.pending():
+            rlist, _, _ = select.select([self._ssl], [], [], wait)
+            if len(rlist) == 0:
+                return None
+        try:
+            buff = self._ssl.read(ERROR_RESPONSE_LENGTH)
+        except SSLError, err:
+            if err.args[0] == SSL_ERROR_WANT_READ:
+                return None # only part of a record has arrived
+            buff = ''
+        if len(buff) != ERROR_RESPONSE_LENGTH:
+            _logger.warning("APNS closed the connection without an error-response")
+            self._disconnect()
+            return None
+        command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
+        return status, identifier
+
+    def _await_error_responses(self, identifier, wait):
+        """
+        Reads error-responses until wait seconds pass without one. Each one
+        resends what APNS dropped after the failed notification and starts the
+        wait over for the resent ones. Returns the status of an error-response
+        for identifier, otherwise 0.
+        """
+        deadline = time.time() + wait
+        while self.connection_alive:
+            remaining = deadline - time.time()
+            response = self._read_error_response(max(remaining, 0))
+            if response is None:
+                if remaining <= 0:
+                    break
+                continue # part of a record, read the rest
+            status, error_identifier = response
+            _logger.info("got error-response from APNS: %d for identifier %d" % (status, error_identifier))
+            failed = self._resend_after(error_identifier)
+            if error_identifier == identifier:
+                return status
+            # reported as sent already, only the listener still hears of it
+            if self._response_listener:
+                self._response_listener({ER_STATUS: status, ER_IDENTIFER: error_identifier,
+                                         'token': failed and failed.get('token')})
+            deadline = time.time() + wait
+        return 0
+
+    def _resend_after(self, failed_identifier):
+        """
+        APNS drops every notification sent after a failed one on the same
+        connection, including those already reported as sent. Sends them
+        again on a fresh connection from the buffer of recent notifications,
+        and returns the failed one, or None when it is no longer buffered.
+        """
+        self._disconnect()
+        sent = list(self._sent_notifications)
+        self._sent_notifications.clear()
+        for i in xrange(len(sent) - 1, -1, -1):
+            if sent[i]['id'] == failed_identifier:
+                break
+        else:
+            _logger.warning("identifier %d is no longer buffered, nothing resent" % failed_identifier)
+            return None
+        if i + 1 < len(sent):
+            _logger.info("resending %d notifications sent after identifier %d" % (len(sent) - i - 1, failed_identifier))
+        for notification in sent[i + 1:]:
+            self.write(notification['message'])
+            self._sent_notifications.append(notification)
+        return sent[i]
+
+    def register_response_listener(self, response_listener):
+        """
+        response_listener is called with the status, identifier and token of
+        an error-response that arrived after its notification was reported
+        as sent
+        """
+        self._response_listener = response_listener
+
     def send_notification_multiple(self, frame):
         self._sent_notifications += frame.get_notifications(self)
         return self.write(frame.get_frame())
@@ -0,0 +1,186 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Local stand-in for the APNS gateway, so the pooled gateway connection and
+# its resends can be measured without Apple's servers. Run it outside App
+# Engine with a throwaway self-signed credential:
+#
+#   openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost \
+#       -keyout key.pem -out cert.pem
+#   python apns_fake.py cert.pem key.pem
+#
+# The App Engine ssl module takes the credential as in-memory PEM, CPython's
+# needs file paths, so connections made here are wrapped with the files.
+
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+
+import apns
+
+
+# bytes of an enhanced notification up to its payload: command, identifier,
+# expiry, token length, token and payload length
+HEADER_LENGTH = 45
+
+
+class FakeGateway(object):
+    # accepts enhanced notifications on a local port, counting TLS handshakes
+    # and identifiers received; answers fail_identifier, the first time it is
+    # seen, with an invalid token error-response after error_delay seconds
+    # and closes that connection, as APNS does
+
+    def __init__(self, certfile, keyfile, fail_identifier=None, error_delay=0.2):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.fail_identifier = fail_identifier
+        self.error_delay = error_delay
+        self.handshakes = 0
+        self.received = []
+        self._lock = threading.Lock()
+        self._listener = socket.socket()
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(50)
+        self.port = self._listener.getsockname()[1]
+        accept = threading.Thread(target=self._accept)
+        accept.daemon = True
+        accept.start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._listener.accept()
+            handler = threading.Thread(target=self._serve, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def _read(self, tls, n):
+        data = ''
+        while len(data) < n:
+            chunk = tls.read(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _serve(self, conn):
+        try:
+            tls = ssl.wrap_socket(conn, server_side=True, certfile=self.certfile, keyfile=self.keyfile,
+                                  ssl_version=ssl.PROTOCOL_TLSv1_2)
+        except (ssl.SSLError, socket.error):
+            return
+        with self._lock:
+            self.handshakes += 1
+        try:
+            while True:
+                header = self._read(tls, HEADER_LENGTH)
+                if header is None:
+                    return
+                identifier = struct.unpack('!I', header[1:5])[0]
+                length = struct.unpack('!H', header[43:45])[0]
+                if self._read(tls, length) is None:
+                    return
+                with self._lock:
+                    first = identifier not in self.received
+                    self.received.append(identifier)
+                if identifier == self.fail_identifier and first:
+                    # later notifications may still arrive, they are dropped
+                    time.sleep(self.error_delay)
+                    tls.write(struct.pack(apns.ERROR_RESPONSE_FORMAT, 8, 8, identifier))
+                    return
+        except (ssl.SSLError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def reset(self):
+        with self._lock:
+            self.handshakes = 0
+            self.received = []
+
+
+def _wrap_with_files(certfile, keyfile):
+    wrap_socket = apns.wrap_socket
+
+    def wrap(sock, **kwargs):
+        kwargs['certfile'] = certfile
+        kwargs['keyfile'] = keyfile
+        return wrap_socket(sock, **kwargs)
+    apns.wrap_socket = wrap
+
+
+def send(gateway, pooled, identifiers, cert, key, errors=None):
+    # one APNs per notification, as each push task creates its own;
+    # returns the statuses, late error-responses are added to errors
+    payload = apns.Payload(alert='title_NotifyFileAvailable', custom={'nonce': 'benchmark'})
+    statuses = []
+    for identifier in identifiers:
+        connection = apns.APNs(use_sandbox=True, cert_file=cert, key_file=key,
+                               enhanced=True, pooled=pooled).gateway_server
+        connection.server = '127.0.0.1'
+        connection.port = gateway.port
+        if errors is not None:
+            connection.register_response_listener(errors.append)
+        statuses.append(connection.send_notification('ab' * 32, payload, identifier=identifier))
+    return statuses
+
+
+def main():
+    certfile, keyfile = sys.argv[1:3]
+    count = 40
+    if len(sys.argv) > 3:
+        count = int(sys.argv[3])
+    _wrap_with_files(certfile, keyfile)
+    cert = open(certfile).read()
+    key = open(keyfile).read()
+    identifiers = range(1, count + 1)
+
+    gateway = FakeGateway(certfile, keyfile)
+    for pooled in (False, True):
+        gateway.reset()
+        start = time.time()
+        statuses = send(gateway, pooled, identifiers, cert, key)
+        elapsed = time.time() - start
+        time.sleep(0.5)
+        print 'pooled=%s: %d sends in %.2f secs, %.1f ms/send, %d handshakes, %d received, %d errors' % (
+            pooled, count, elapsed, elapsed * 1000 / count, gateway.handshakes,
+            len(set(gateway.received)), len([s for s in statuses if s != 0]))
+
+    # an error-response within the wait is returned by the failed send itself;
+    # one after it arrives while a later send waits, which reports it to the
+    # listener and sends again what APNS dropped after the failed notification
+    failed = count // 2
+    for error_delay in (0.2, apns.WAIT_ERROR_RESPONSE_SEC + 0.2):
+        apns._gateway_pool.clear()
+        failing = FakeGateway(certfile, keyfile, fail_identifier=failed, error_delay=error_delay)
+        errors = []
+        statuses = send(failing, True, identifiers, cert, key, errors)
+        missing = sorted(set(identifiers) - set(failing.received) - set([failed]))
+        print 'error after %.1f secs: status %d for identifier %d, %d handshakes, late errors %s, missing: %s' % (
+            error_delay, statuses[failed - 1], failed, failing.handshakes,
+            [(e[apns.ER_IDENTIFER], e[apns.ER_STATUS]) for e in errors], missing or 'none')
+
+
+if __name__ == '__main__':
+    main()
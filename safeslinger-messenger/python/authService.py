@@ -29,6 +29,7 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 
 import apnsAuthToken
 import c2dmAuthToken
+import credcache
 import gcmAuthToken 
 import loginGoogle
 
@@ -130,6 +131,7 @@ class APNSLogin(webapp.RequestHandler):
                 credential = apnsAuthToken.APNSAuthToken(apnsCert=apnsCert, apnsKey=apnsKey, username=user.email(), comment=comments, lookuptag=lookup)
 
             credential.put()
+            credcache.invalidate()
             key = credential.key()
             insertSuccess = True
             if not key.has_id_or_name():
@@ -178,6 +180,7 @@ class C2dmLogin(webapp.RequestHandler):
             # store result
             tokenStore = c2dmAuthToken.C2dmAuthToken(token=clientAuth, username=user.email(), comment=comments)
             tokenStore.put()
+            credcache.invalidate()
             key = tokenStore.key()
             insertSuccess = True
             if not key.has_id_or_name():
@@ -222,6 +225,7 @@ class GcmLogin(webapp.RequestHandler):
             # store result
             credential = gcmAuthToken.GcmAuthToken(gcmkey=gcmKey, username=user.email(), comment=comments)
             credential.put()
+            credcache.invalidate()
             key = credential.key()
             insertSuccess = True
             if not key.has_id_or_name():
@@ -30,6 +30,7 @@ from google.appengine.ext.webapp import util
 import c2dmAuthToken
 import cloudstorage as gcs
 import filestorage
+import regcache
 import registration
 
 
@@ -82,6 +83,7 @@ class CleanUp(webapp.RequestHandler):
                                 logging.warn('Registration marked inactive: (%i)%s... k:%s...' % (reg.notify_type, reg.registration_id[0:10], reg.key_id[0:10]))
                                 reg.active = False
                                 reg.put()
+                                regcache.store(reg)
                                 
                             # only log push accepted messages removed, others would error out
                             logging.info('Message pending removed aged: %s' % str(now - f.inserted))
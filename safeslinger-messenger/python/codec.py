@@ -0,0 +1,57 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import struct
+
+
+class Reader(object):
+    # offset-based reader over the request body, fields are unpacked in place
+    # from a memoryview instead of reslicing the remaining buffer each time
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.view = memoryview(data)
+        self.pos = pos
+
+    def remaining(self):
+        return len(self.data) - self.pos
+
+    def read_int(self):
+        value = struct.unpack_from('!i', self.view, self.pos)[0]
+        self.pos = self.pos + 4
+        return value
+
+    def read_ints(self, n):
+        # bulk unpack of an id array
+        if n <= 0:
+            return ()
+        values = struct.unpack_from('!%di' % n, self.view, self.pos)
+        self.pos = self.pos + (4 * n)
+        return values
+
+    def read_blob(self, n):
+        value = self.view[self.pos:(self.pos + n)].tobytes()
+        self.pos = self.pos + n
+        return value
+
+    def read_rest(self):
+        return self.read_blob(self.remaining())
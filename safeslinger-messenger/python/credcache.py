@@ -0,0 +1,104 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+
+from google.appengine.api import memcache
+
+import apnsAuthToken
+import c2dmAuthToken
+import gcmAuthToken
+
+
+# credentials change only when an admin submits new ones; the ttl bounds
+# how long an instance keeps them if the generation key is lost
+CACHE_TTL = 300
+GENERATION_KEY = 'cred:gen'
+
+# name -> (generation, expires, value)
+_local = {}
+
+
+def _generation():
+    # bumped by invalidate so every instance drops its copies
+    gen = memcache.get(GENERATION_KEY)
+    if gen is None:
+        # start from the clock so a reset counter won't repeat old generations
+        gen = memcache.incr(GENERATION_KEY, initial_value=int(time.time()))
+    return gen
+
+
+def _cached(name, load, *args):
+    now = time.time()
+    gen = _generation()
+    cached = _local.get(name)
+    if cached is not None and cached[0] == gen and cached[1] > now:
+        return cached[2]
+    value = load(*args)
+    _local[name] = (gen, now + CACHE_TTL, value)
+    return value
+
+
+def invalidate():
+    # called after new credentials are stored
+    _local.clear()
+    memcache.incr(GENERATION_KEY, initial_value=int(time.time()))
+
+
+def _load_c2dm():
+    query = c2dmAuthToken.C2dmAuthToken.all().order('-inserted')
+    token = query.get()  # only want the latest
+    if token is None:
+        return None
+    return token.token
+
+
+def _load_apns(lookuptag):
+    query = apnsAuthToken.APNSAuthToken.all()
+    query.filter('lookuptag =', lookuptag)
+    credential = query.get()  # only want the latest
+    if credential is None:
+        return None
+    return (credential.apnsCert, credential.apnsKey)
+
+
+def _load_gcm():
+    query = gcmAuthToken.GcmAuthToken.all().order('-inserted')
+    token = query.get()  # only want the latest
+    if token is None:
+        return None
+    return token.gcmkey
+
+
+def c2dm_token():
+    # latest C2DM client auth token, None when there is none
+    return _cached('c2dm', _load_c2dm)
+
+
+def apns_credential(lookuptag):
+    # (cert, key) for 'production' or 'test', None when there is none
+    return _cached('apns:' + lookuptag, _load_apns, lookuptag)
+
+
+def gcm_key():
+    # latest GCM api key, None when there is none
+    return _cached('gcm', _load_gcm)
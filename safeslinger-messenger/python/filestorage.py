@@ -35,3 +35,18 @@ class FileStorage(db.Model):
     notify_type = db.IntegerProperty()
     downloaded = db.BooleanProperty(required=True, default=False)
     push_accepted = db.BooleanProperty(required=True, default=False)
+
+
+def file_key(retrievalId):
+    # messages are keyed by retrieval id so lookups are a strongly consistent get
+    return db.Key.from_path('FileStorage', retrievalId)
+
+
+def get_file(retrievalId):
+    filestore = db.get(file_key(retrievalId))
+    if filestore is None:
+        # rows stored before messages were keyed by retrieval id
+        query = FileStorage.all()
+        query.filter('id =', retrievalId)
+        filestore = query.get()
+    return filestore
@@ -29,6 +29,7 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 
 import cloudstorage as gcs
+import codec
 import filestorage
 
 
@@ -71,8 +72,8 @@ class GetFile(webapp.RequestHandler):
             return
 
         # unpack all incoming data
-        client = (struct.unpack("!i", data[0:4]))[0]
-        data = data[4:]
+        reader = codec.Reader(data)
+        client = reader.read_int()
 
         # client version check
         if client < INT_VERCLIENT:
@@ -82,21 +83,14 @@ class GetFile(webapp.RequestHandler):
         server = int(CURRENT_VERSION_ID[0:8], 16)
 
         # unpack all incoming data
-        pos = 0
+        lenrid = reader.read_int()
+        retrievalId = base64.encodestring(reader.read_blob(lenrid))
         
-        lenrid = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-        pos = pos + 4
-        retrievalId = base64.encodestring(data[pos:(pos + lenrid)])
-        pos = pos + lenrid
-        
-        # query for file in database
-        query = filestorage.FileStorage.all()
-        query.filter('id =', retrievalId)
-        items = query.fetch(1000)
+        # get file from database by its retrieval id
+        filestore = filestorage.get_file(retrievalId)
 
         # if found package up file and return it
-        num = 0
-        for filestore in items:
+        if filestore is not None:
 
             filename = filestore.blobkey
             if filename:
@@ -118,10 +112,9 @@ class GetFile(webapp.RequestHandler):
             self.response.out.write('%s' % struct.pack('!i', server))
             self.response.out.write('%s' % (struct.pack('!i', 1)))
             self.response.out.write('%s%s' % (struct.pack('!i', lenfd), fileData))
-            num = num + 1
 
         # not found, send back error message
-        if num == 0:            
+        else:            
             self.resp_simple(0, 'Error=MessageNotFound')
             return
     
@@ -28,6 +28,7 @@ import struct
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 
+import codec
 import filestorage
 
 
@@ -70,8 +71,8 @@ class GetMessage(webapp.RequestHandler):
             return
 
         # unpack all incoming data
-        client = (struct.unpack("!i", data[0:4]))[0]
-        data = data[4:]
+        reader = codec.Reader(data)
+        client = reader.read_int()
 
         # client version check
         if client < INT_VERCLIENT:
@@ -81,21 +82,14 @@ class GetMessage(webapp.RequestHandler):
         server = int(CURRENT_VERSION_ID[0:8], 16)
 
         # unpack all incoming data
-        pos = 0
+        lenrid = reader.read_int()
+        retrievalId = base64.encodestring(reader.read_blob(lenrid))
         
-        lenrid = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-        pos = pos + 4
-        retrievalId = base64.encodestring(data[pos:(pos + lenrid)])
-        pos = pos + lenrid
-        
-        # query for file in database
-        query = filestorage.FileStorage.all()
-        query.filter('id =', retrievalId)
-        num = query.count()
+        # get file from database by its retrieval id
+        item = filestorage.get_file(retrievalId)
 
         # if found package up file, updated status, and return it
-        if num == 1:
-            item = query.get()
+        if item is not None:
             msgData = item.msg
             lenmsg = str.__len__(msgData)
             self.response.out.write('%s' % struct.pack('!i', server))
@@ -104,7 +98,7 @@ class GetMessage(webapp.RequestHandler):
             item.downloaded = True
             item.put()
         # not found, send back error message
-        elif num == 0:            
+        else:            
             self.resp_simple(0, 'Error=MessageNotFound')
             return
     
@@ -33,6 +33,8 @@ from Crypto.Signature import PKCS1_v1_5
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 
+import codec
+import regcache
 import registration
 
 
@@ -75,7 +77,8 @@ class PostRegistration(webapp.RequestHandler):
             return
 
         # unpack all incoming data
-        client = (struct.unpack("!i", data[0:4]))[0]
+        reader = codec.Reader(data)
+        client = reader.read_int()
 
         # client version check
         if client < INT_VERCLIENT:
@@ -88,48 +91,33 @@ class PostRegistration(webapp.RequestHandler):
         submissionAuth = None
         submissionType = 1
 
-        # unpack all incoming data, skip client version 
-        pos = 4        
+        # unpack all incoming data, client version already read
+        lenkeyid = reader.read_int()
+        keyId = reader.read_blob(lenkeyid)
 
-        lenkeyid = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-        pos = pos + 4
-        keyId = data[pos:(pos + lenkeyid)]
-        pos = pos + lenkeyid
-
-        lensubtok = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-        pos = pos + 4
-        submissionToken = str(data[pos:(pos + lensubtok)])
-        pos = pos + lensubtok
+        lensubtok = reader.read_int()
+        submissionToken = reader.read_blob(lensubtok)
 
         if lensubtok >= 32:  # 256-bit original SHA-3 minimum, before base-64 encoding
             submissionAuth = submissionToken
             submissionType = 1  # version 1 of authentication
 
-        lenregid = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-        pos = pos + 4
-        registrationId = str(data[pos:(pos + lenregid)])
-        pos = pos + lenregid
+        lenregid = reader.read_int()
+        registrationId = reader.read_blob(lenregid)
 
-        devtype = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-        pos = pos + 4
+        devtype = reader.read_int()
         
         # additional verifying for self signing
-        if size > pos:  # still has data
-            lennonce = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-            pos = pos + 4
-            nonce = str(data[pos:(pos + lennonce)])
-            pos = pos + lennonce
+        if reader.remaining() > 0:  # still has data
+            lennonce = reader.read_int()
+            nonce = reader.read_blob(lennonce)
             
-            lenpubkey = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-            pos = pos + 4
-            pubkey = str(data[pos:(pos + lenpubkey)])
-            pos = pos + lenpubkey
-            plain_pos = pos
+            lenpubkey = reader.read_int()
+            pubkey = reader.read_blob(lenpubkey)
+            plain_pos = reader.pos
             
-            sig_len = (struct.unpack("!i", data[pos:(pos + 4)]))[0]
-            pos = pos + 4
-            sig = data[pos:(pos + sig_len)]
-            pos = pos + sig_len
+            sig_len = reader.read_int()
+            sig = reader.read_blob(sig_len)
             
             # signature verification
             if lenpubkey > 0:
@@ -177,6 +165,7 @@ class PostRegistration(webapp.RequestHandler):
                     if not key.has_id_or_name():
                         self.resp_simple(0, 'Unable to update registration.')
                         return       
+                    regcache.store(reg_old)
                 # if record missing, insert it
                 else:
                     reg_new = registration.Registration(key_id=keyId, submission_token=submissionAuth, submission_type=submissionType, registration_id=registrationId, notify_type=devtype, client_ver=client)        
@@ -185,6 +174,7 @@ class PostRegistration(webapp.RequestHandler):
                     if not key.has_id_or_name():
                         self.resp_simple(0, 'Unable to create new registration.')
                         return       
+                    regcache.store(reg_new)
 
             # token not authentic, just log it
             else:
@@ -198,6 +188,7 @@ class PostRegistration(webapp.RequestHandler):
             if not key.has_id_or_name():
                 self.resp_simple(0, 'Unable to create new registration.')
                 return       
+            regcache.store(reg_new)
 
         # SEND RESPONSE =========================================        
         # this client background process does not need to log back insert/update errors to the client
@@ -0,0 +1,358 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import Queue
+import datetime
+import httplib
+import logging
+import os
+import random
+import threading
+import urllib, urllib2
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.runtime import DeadlineExceededError
+
+from apns import APNs, ER_STATUS, Payload, PayloadAlert
+import c2dm
+import credcache
+import filestorage
+import regcache
+
+
+PUSH_URL = '/task/push'
+QUEUE_NAME = 'push'
+
+# outcome of one delivery attempt
+DELIVERED = 0
+RETRY = 1  # transient, the queue tries again after its backoff
+FAILED = 2  # permanent, the message stays without push_accepted
+
+
+class TaskQueueDispatcher(object):
+    # push tasks on the 'push' queue, retried with the backoff in queue.yaml
+
+    def enqueue(self, params, transactional=False):
+        taskqueue.add(url=PUSH_URL, params=params, queue_name=QUEUE_NAME, transactional=transactional)
+
+
+class LocalDispatcher(object):
+    # in-process stand-in for the push queue so the pipeline can be load
+    # tested offline: worker threads run deliver with the same doubling
+    # backoff and keep a count of each outcome
+
+    def __init__(self, deliver=None, workers=4, retry_limit=7, min_backoff=0.25, max_backoff=32):
+        self.deliver = deliver or globals()['deliver']
+        self.retry_limit = retry_limit
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.tasks = Queue.Queue()
+        self.done = threading.Condition()
+        self.pending = 0
+        self.counts = {'enqueued': 0, 'delivered': 0, 'retried': 0, 'failed': 0}
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def enqueue(self, params, transactional=False):
+        with self.done:
+            self.pending += 1
+            self.counts['enqueued'] += 1
+        self.tasks.put((dict(params), 0))
+
+    def join(self):
+        # wait until every task has been delivered or has failed for good
+        with self.done:
+            while self.pending > 0:
+                self.done.wait()
+
+    def _work(self):
+        while True:
+            params, attempt = self.tasks.get()
+            try:
+                outcome = self.deliver(params)
+            except Exception:
+                logging.exception('push task failed')
+                outcome = RETRY
+            with self.done:
+                if outcome == RETRY and attempt < self.retry_limit:
+                    self.counts['retried'] += 1
+                    backoff = min(self.min_backoff * (2 ** attempt), self.max_backoff)
+                    timer = threading.Timer(backoff, self.tasks.put, ((params, attempt + 1),))
+                    timer.daemon = True
+                    timer.start()
+                    continue
+                if outcome == DELIVERED:
+                    self.counts['delivered'] += 1
+                else:
+                    self.counts['failed'] += 1
+                self.pending -= 1
+                self.done.notify_all()
+
+
+def task_params(filestore, devtype, recipientToken, canonicalId, regKey):
+    # everything the worker needs to push for a stored message
+    params = {'key': str(filestore.key()), 'devtype': devtype, 'token': recipientToken}
+    if canonicalId is not None:
+        params['canonical'] = canonicalId
+    if regKey is not None:
+        params['reg'] = regKey
+    return params
+
+
+def deliver(params):
+    # one push attempt for a stored message, marks it push_accepted once the
+    # push service took it
+    filestore = db.get(params['key'])
+    if filestore is None:
+        logging.info('Message expired before push, dropping task.')
+        return FAILED
+    if filestore.push_accepted:
+        return DELIVERED  # task ran twice
+
+    reg_new = None
+    if params.get('reg'):
+        reg_new = db.get(params['reg'])
+
+    devtype = int(params['devtype'])
+    recipientToken = params['token']
+    if devtype == 1:
+        outcome = send_c2dm(filestore.id, recipientToken, reg_new)
+    elif devtype == 2:
+        outcome = send_apns(filestore.id, recipientToken, reg_new)
+    elif devtype == 3:
+        outcome = send_gcm(filestore.id, recipientToken, params.get('canonical'), reg_new)
+    else:
+        logging.error('Sending to device type %i not yet implemented.' % devtype)
+        outcome = FAILED
+
+    if outcome == DELIVERED:
+        # mark push complete to differentiate between inserted data, but failed push
+        filestore.push_accepted = True
+        filestore.put()
+    return outcome
+
+
+def send_c2dm(retrievalId, recipientToken, reg_new):
+    # send push message to Android service...
+    sender = c2dm.C2DM()
+    sender.registrationId = recipientToken
+    sender.collapseKey = retrievalId
+    sender.fileid = retrievalId
+
+    # grab latest auth token from our cache
+    sender.clientAuth = credcache.c2dm_token()
+    if sender.clientAuth is None:
+        logging.error('One C2DM authorization token expected, 0 found.')
+        return RETRY
+
+    respMessage = sender.sendMessage()
+
+    # if push service shows unregistered device, save the status
+    if respMessage.find('Error=NotRegistered') != -1:
+        if reg_new is not None:
+            reg_new.active = False
+            reg_new.put()
+            regcache.store(reg_new)
+
+    if respMessage.find('Error=PushServiceFail') != -1:
+        logging.error('C2DM: %s' % respMessage)
+        return RETRY
+    if respMessage.find('Error') != -1:
+        logging.error('C2DM: %s' % respMessage)
+        return FAILED
+    return DELIVERED
+
+
+def send_apns(retrievalId, recipientToken, reg_new):
+    CURRENT_VERSION_ID = os.environ.get('CURRENT_VERSION_ID', '01060000')
+    isProd = CURRENT_VERSION_ID[8:9] == 'p'
+
+    # grab latest proper credential from our cache
+    if isProd:
+        credential = credcache.apns_credential('production')
+    else:
+        credential = credcache.apns_credential('test')
+
+    if credential is None:
+        logging.error('One APNS credential expected, 0 found.')
+        return RETRY
+    APNS_CERT, APNS_KEY = credential
+
+    apns = None
+    if isProd:
+        apns = APNs(use_sandbox=False, cert_file=APNS_CERT, key_file=APNS_KEY, enhanced=True, pooled=True)
+    else:
+        apns = APNs(use_sandbox=True, cert_file=APNS_CERT, key_file=APNS_KEY, enhanced=True, pooled=True)
+
+    # update badge number
+    query = filestorage.FileStorage.all()
+    undownloaded = False
+    query.filter('sender_token =', recipientToken).filter('downloaded = ', undownloaded)
+    badge = query.count()
+
+    # Send a notification
+    apnsmessage = {}
+    apnsmessage['data'] = {}
+    apnsmessage['sound'] = 'default'
+    apnsmessage['badge'] = badge
+    apnsmessage['alert'] = PayloadAlert("title_NotifyFileAvailable", loc_key="title_NotifyFileAvailable")
+    apnsmessage['custom'] = {'nonce': retrievalId}
+
+    payload = Payload(alert=apnsmessage['alert'], sound=apnsmessage['sound'], custom=apnsmessage['custom'], badge=apnsmessage['badge'])
+
+    # Status code
+    # 0 No errors encountered
+    # 1 Processing error
+    # 2 Missing device token
+    # 3 Missing topic
+    # 4 Missing payload
+    # 5 Invalid token size
+    # 6 Invalid topic size
+    # 7 Invalid payload size
+    # 8 Invalid token
+    # 10 Shutdown
+    # 255 None (unknown)
+    status = 0
+    try:
+        identifier = random.getrandbits(32)
+        gateway = apns.gateway_server
+        gateway.register_response_listener(apns_late_error)
+        # a single attempt, a failure is retried by the push queue
+        status = gateway.send_notification(recipientToken, payload, identifier=identifier, retry=False)
+    except DeadlineExceededError:
+        logging.info("DeadlineExceededError - timeout.")
+        return RETRY
+
+    # if push service shows unregistered device, save the status.
+    # if test/prod clients are not in sync with test/prod servers, they will be set inactive
+    if status == 8:
+        if reg_new is not None:
+            reg_new.active = False
+            reg_new.put()
+            regcache.store(reg_new)
+
+    # received status from SSL socket, handle appropriately
+    if status == 0:
+        logging.info("Remote Notification successfully sent to APNS, code: " + str(status))
+        return DELIVERED
+    elif status == 1 or status == 10:
+        logging.error("Error: 500, Internal Server Error or APNS Unavailable. Our system failed. If this persists, contact support..")
+        return RETRY
+    elif status == 2 or status == 5 or status == 8:
+        logging.error('APNS: Error=InvalidRegistration')
+        return FAILED
+    else:
+        logging.error("APNS Error: (code = %d)" % status)
+        return FAILED
+
+
+def apns_late_error(response):
+    # error-response for an earlier notification on the pooled connection,
+    # read while waiting on this one; an invalid token is still marked
+    # inactive as send_apns would have
+    token = response.get('token')
+    if response[ER_STATUS] != 8 or token is None:
+        logging.error("APNS late error: (code = %d)" % response[ER_STATUS])
+        return
+    latest = regcache.resolve(token)
+    if latest is None or latest['registration_id'] != token:
+        return  # already replaced by a newer registration
+    reg = db.get(latest['key'])
+    if reg is not None and reg.active:
+        reg.active = False
+        reg.put()
+        regcache.store(reg)
+
+
+def send_gcm(retrievalId, recipientToken, canonicalId, reg_new):
+    # grab latest proper credential from our cache
+    GCM_KEY = credcache.gcm_key()
+    if GCM_KEY is None:
+        logging.error('One GCM key expected, 0 found.')
+        return RETRY
+
+    # Build payload
+    if canonicalId is not None:
+        proper_registration_id = canonicalId
+        logging.info('Canonical ID found, using canon %s..., not reg %s...' % (canonicalId[0:10], recipientToken[0:10]))
+    else:
+        proper_registration_id = recipientToken
+
+    values = {'registration_id' : proper_registration_id,
+              'data.msgid': retrievalId,
+    }
+
+    # Build request
+    headers = {'Authorization': 'key=' + GCM_KEY}
+    data = urllib.urlencode(values)
+    request = urllib2.Request('https://android.googleapis.com/gcm/send', data, headers)
+
+    # one attempt per task run, the queue backs off between attempts
+    try:
+        response = urllib2.urlopen(request, timeout=10)
+        respMessage = response.read()
+        logging.info('%s' % respMessage)
+    except httplib.HTTPException, e:
+        logging.info("GCM HTTPException: ." + str(e))
+        return RETRY
+    except urllib2.HTTPError, e:
+        logging.error("GCM HTTPError: ." + str(e))
+        if e.code == 500 or e.code == 503:
+            return RETRY
+        return FAILED
+    except urllib2.URLError, e:
+        logging.info("GCM URLError: ." + str(e))
+        return RETRY
+
+    # If second line starts with registration_id, gets its value and replace the registration IDs in your server database.
+    lines = respMessage.splitlines()
+    if lines.__len__() == 2:
+        kv = lines[1].split('=')
+        if kv[0] == 'registration_id':
+            # Avoid writing canonical Id when old one matches.
+            if canonicalId != kv[1]:
+                if reg_new is not None:
+                    # update registration entry with canonical id
+                    reg_new.canonical_id = kv[1]
+                    reg_new.canonical_updated = datetime.datetime.now()
+                    reg_new.put()
+                    regcache.store(reg_new)
+
+    # if push service shows unregistered device, save the status
+    if respMessage.find('Error=NotRegistered') != -1:
+        if reg_new is not None:
+            reg_new.active = False
+            reg_new.put()
+            regcache.store(reg_new)
+
+    if respMessage.find('Error=Unavailable') != -1:
+        return RETRY
+    if respMessage.find('Error=') != -1:
+        logging.error('GCM: %s' % respMessage)
+        return FAILED
+    return DELIVERED
+
+
+dispatcher = TaskQueueDispatcher()
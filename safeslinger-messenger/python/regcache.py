@@ -0,0 +1,123 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2010-2015 Carnegie Mellon University
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import hashlib
+import time
+
+from google.appengine.api import memcache
+
+import registration
+
+
+# entries are rewritten on every registration change, the ttl only bounds
+# how long a lost update can last
+CACHE_TTL = 3600
+# other instances' local copies are not reached by an update, so they are
+# trusted only briefly
+LOCAL_TTL = 10
+LOCAL_MAX_ENTRIES = 512
+
+# cached for tokens and key ids without a registration
+MISSING = ''
+
+# cache key -> (expires, value), least recently used first
+_local = collections.OrderedDict()
+
+
+def _token_key(token):
+    # push tokens may be longer than a memcache key
+    return 'reg:tok:%s' % hashlib.sha1(token).hexdigest()
+
+
+def _keyid_key(keyId):
+    return 'reg:key:%s' % hashlib.sha1(keyId).hexdigest()
+
+
+def _cached(key, load, *args):
+    now = time.time()
+    cached = _local.pop(key, None)
+    if cached is not None and cached[0] > now:
+        _local[key] = cached
+        return cached[1]
+
+    value = memcache.get(key)
+    if value is None:
+        value = load(*args)
+        memcache.set(key, value, time=CACHE_TTL)
+
+    _remember(key, value, now)
+    return value
+
+
+def _remember(key, value, now):
+    _local.pop(key, None)
+    _local[key] = (now + LOCAL_TTL, value)
+    while len(_local) > LOCAL_MAX_ENTRIES:
+        _local.popitem(last=False)
+
+
+def _load_keyid(token):
+    query = registration.Registration.all().order('-inserted')
+    query.filter('registration_id =', token)
+    reg = query.get()  # only want the latest
+    if reg is None:
+        return MISSING
+    return reg.key_id
+
+
+def _load_latest(keyId):
+    query = registration.Registration.all().order('-inserted')
+    query.filter('key_id =', keyId)
+    reg = query.get()  # only want the latest
+    if reg is None:
+        return MISSING
+    return _fields(reg)
+
+
+def _fields(reg):
+    return {'key': str(reg.key()),
+            'registration_id': reg.registration_id,
+            'notify_type': reg.notify_type,
+            'canonical_id': reg.canonical_id,
+            'active': reg.active}
+
+
+def resolve(token):
+    # the latest registration of the key id that registered the token, as a
+    # dict of its key and push fields, None when the token is unknown
+    keyId = _cached(_token_key(token), _load_keyid, token)
+    if not keyId:
+        return None
+    return _cached(_keyid_key(keyId), _load_latest, keyId) or None
+
+
+def store(reg):
+    # called after a registration is put, it is now the latest of its key id
+    # and token; written through since a query right after the put may
+    # still return the previous one
+    values = {_token_key(reg.registration_id): reg.key_id,
+              _keyid_key(reg.key_id): _fields(reg)}
+    memcache.set_multi(values, time=CACHE_TTL)
+    now = time.time()
+    for key, value in values.items():
+        _remember(key, value, now)